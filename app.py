@@ -2,16 +2,138 @@
 from io import BytesIO
 import os
 import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
 import zipfile
 import base64
+import cProfile
+import functools
+import hashlib
+import mmap
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, g, render_template, request, jsonify, send_file
 from PIL import Image, ImageDraw, ImageFont
+from werkzeug.exceptions import RequestEntityTooLarge
 import fitz  # PyMuPDF
+import numpy as np
 import json
+import math
+import multiprocessing
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 
+# ========== 性能指标 ==========
+# 开启后在响应头 X-Render-Timing 中返回本次请求各阶段耗时
+RENDER_TIMING_HEADER = os.environ.get("RENDER_TIMING_HEADER", "0") == "1"
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """按单个标签分组的耗时直方图，输出 Prometheus 文本格式（进程内统计）"""
+
+    def __init__(self, name, help_text, label, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # 标签值 -> [各桶计数..., 总和, 次数]
+
+    def observe(self, value, seconds):
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for value, series in sorted(self._series.items()):
+                label = f'{self.label}="{value}"'
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("handwriting_stage_seconds", "渲染流水线各阶段耗时（秒）", "stage")
+REQUEST_SECONDS = Histogram("handwriting_request_seconds", "接口处理耗时（秒，流式响应不含输出阶段）", "endpoint")
+_timing_local = threading.local()
+
+
+def observe_stage(stage, seconds):
+    """记录一次阶段耗时；当前线程正在收集时同时累加到收集结果中"""
+    STAGE_SECONDS.observe(stage, seconds)
+    recorder = getattr(_timing_local, "recorder", None)
+    if recorder is not None:
+        recorder[stage] = recorder.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def record_stages():
+    """在当前线程收集各阶段耗时合计，用于响应头和子进程回传"""
+    previous = getattr(_timing_local, "recorder", None)
+    recorder = _timing_local.recorder = {}
+    try:
+        yield recorder
+    finally:
+        _timing_local.recorder = previous
+
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    g.stage_timings = _timing_local.recorder = {}
+
+
+@app.after_request
+def finish_request_timing(response):
+    start = g.pop("request_start", None)
+    if start is not None and request.endpoint:
+        REQUEST_SECONDS.observe(request.endpoint, time.perf_counter() - start)
+    timings = g.pop("stage_timings", None)
+    if RENDER_TIMING_HEADER and timings:
+        response.headers["X-Render-Timing"] = ", ".join(
+            f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+        )
+    return response
+
+
+@app.teardown_request
+def stop_request_timing(exc):
+    # 流式响应的生成阶段在请求结束之后，只计入直方图
+    _timing_local.recorder = None
+
+
 # 字体配置
 FONT_DIR = os.path.join(app.static_folder, "fonts")
 AVAILABLE_FONTS = {
@@ -26,9 +148,2109 @@ AVAILABLE_FONTS = {
 }
 
 
-def get_font_path(font_key):
-    font_info = AVAILABLE_FONTS.get(font_key, AVAILABLE_FONTS["lxgw"])
-    return os.path.join(FONT_DIR, font_info["file"])
+def get_font_path(font_key):
+    font_info = AVAILABLE_FONTS.get(font_key, AVAILABLE_FONTS["lxgw"])
+    return os.path.join(FONT_DIR, font_info["file"])
+
+
+# 字体缓存配置（每个进程一份，单位MB，可通过环境变量调整）
+FONT_CACHE_MAX_MB = int(os.environ.get("FONT_CACHE_MAX_MB", "64"))
+# 每个字号实例（FreeType face + 字形缓存）的估算内存占用
+FONT_FACE_OVERHEAD_BYTES = 256 * 1024
+
+
+# path: 字体文件路径；data: 文件的只读 mmap（不可用时为 None）
+# kind: truetype / cff；error: 不可用的原因
+FontFile = namedtuple("FontFile", ["path", "data", "kind", "error"])
+
+
+class FontRegistry:
+    """进程级字体缓存
+
+    启动时校验所有字体文件（validate），每个文件只映射一次（mmap），
+    字号实例按路径交给 FreeType 加载，FreeType 同样以只读 mmap 读取字体，
+    所有字号、以及 preload 后 fork 出的 gunicorn worker 共享同一份页缓存。
+    不同字号的 FreeTypeFont 实例按 (font_key, size) 放入 LRU，
+    超出内存上限时淘汰最久未使用的字号。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files = {}  # font_key -> FontFile
+        self._resolved = {}  # 请求的 font_key -> 实际使用的 font_key
+        self.fallback_key = None
+        self._faces = OrderedDict()  # (font_key, size) -> FreeTypeFont
+        self._used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _open_file(font_path):
+        try:
+            with timed("font_load"):
+                with open(font_path, "rb") as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # 确认 FreeType 能解析
+                ImageFont.truetype(font_path, 12)
+        except (OSError, ValueError) as e:
+            return FontFile(font_path, None, None, str(e))
+        kind = "cff" if data[:4] == b"OTTO" else "truetype"
+        return FontFile(font_path, data, kind, None)
+
+    def validate(self):
+        """校验所有字体文件，确定降级字体（lxgw 不可用时取第一个可用字体）"""
+        with self._lock:
+            for font_key in AVAILABLE_FONTS:
+                if font_key not in self._files:
+                    self._files[font_key] = self._open_file(get_font_path(font_key))
+            available = [key for key in AVAILABLE_FONTS if self._files[key].data is not None]
+            self.fallback_key = "lxgw" if "lxgw" in available else (available[0] if available else None)
+            self._resolved = {key: key for key in available}
+
+        for font_key, font_file in self._files.items():
+            if font_file.error:
+                print(f"✗ 字体不可用: {font_key} ({font_file.error})")
+        print(f"✓ 可用字体: {', '.join(available) or '无'}，默认降级字体: {self.fallback_key}")
+        return available
+
+    def is_available(self, font_key):
+        return font_key in self._resolved
+
+    def normalize_key(self, font_key):
+        """未知或不可用的字体降级到默认字体"""
+        return self._resolved.get(font_key, self.fallback_key)
+
+    def font_file(self, font_key):
+        """返回实际使用的字体文件（FontFile），没有任何可用字体时返回 None"""
+        font_key = self.normalize_key(font_key)
+        return self._files.get(font_key) if font_key else None
+
+    def get(self, font_key, size):
+        """返回指定字体和字号的 FreeTypeFont，没有可用字体时返回默认字体"""
+        font_key = self.normalize_key(font_key)
+        size = int(size)
+        cache_key = (font_key, size)
+
+        with self._lock:
+            face = self._faces.get(cache_key)
+            if face is not None:
+                self._faces.move_to_end(cache_key)
+                self.hits += 1
+                return face
+
+            self.misses += 1
+            try:
+                if font_key is None:
+                    raise OSError("没有可用的字体文件")
+                with timed("font_load"):
+                    face = ImageFont.truetype(self._files[font_key].path, size)
+            except Exception as e:
+                print(f"✗ 字体加载失败: {e}，使用默认字体")
+                face = ImageFont.load_default()
+
+            self._faces[cache_key] = face
+            self._used_bytes += FONT_FACE_OVERHEAD_BYTES
+            while self._used_bytes > self.max_bytes and len(self._faces) > 1:
+                self._faces.popitem(last=False)
+                self._used_bytes -= FONT_FACE_OVERHEAD_BYTES
+                self.evictions += 1
+            return face
+
+    def clear(self):
+        with self._lock:
+            self._faces.clear()
+            self._used_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "faces": len(self._faces),
+                "face_bytes": self._used_bytes,
+                "mapped_file_bytes": sum(len(f.data) for f in self._files.values() if f.data is not None),
+                "max_bytes": self.max_bytes,
+            }
+
+
+FONT_REGISTRY = FontRegistry(FONT_CACHE_MAX_MB * 1024 * 1024)
+FONT_REGISTRY.validate()
+
+
+# 字形缓存配置（单位MB，可通过环境变量调整）
+GLYPH_CACHE_MAX_MB = int(os.environ.get("GLYPH_CACHE_MAX_MB", "128"))
+
+# mask: 字形的 L 模式透明度遮罩（空白字符为 None）
+# offset_x/offset_y: 遮罩左上角相对绘制原点的偏移
+# width: 字符宽度（不含加粗描边），用于计算下一个字符的位置
+Glyph = namedtuple("Glyph", ["mask", "offset_x", "offset_y", "width"])
+
+
+class GlyphCache:
+    """预光栅化字形缓存
+
+    每个 (font_key, size, stroke_width, char) 只光栅化一次，
+    之后通过 Image.paste(color, box, mask) 直接合成到页面上，
+    避免每个字符重复调用 draw.text + draw.textbbox。
+    """
+
+    def __init__(self, max_bytes, font_registry):
+        self.max_bytes = max_bytes
+        self.font_registry = font_registry
+        self._lock = threading.Lock()
+        self._glyphs = OrderedDict()  # (font_key, size, stroke_width, char) -> Glyph
+        self._used_bytes = 0
+        self._measure = ImageDraw.Draw(Image.new("L", (1, 1)))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _rasterize(self, font, stroke_width, ch):
+        bbox = self._measure.textbbox((0, 0), ch, font=font)
+        width = bbox[2] - bbox[0]
+
+        if stroke_width > 0:
+            bbox = self._measure.textbbox((0, 0), ch, font=font, stroke_width=stroke_width)
+        left, top, right, bottom = bbox
+        if right <= left or bottom <= top:
+            return Glyph(None, 0, 0, width)
+
+        mask = Image.new("L", (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text(
+            (-left, -top),
+            ch,
+            fill=255,
+            font=font,
+            stroke_width=stroke_width,
+            stroke_fill=255 if stroke_width > 0 else None,
+        )
+        return Glyph(mask, left, top, width)
+
+    def get(self, font_key, size, stroke_width, ch):
+        font_key = self.font_registry.normalize_key(font_key)
+        cache_key = (font_key, int(size), stroke_width, ch)
+
+        with self._lock:
+            glyph = self._glyphs.get(cache_key)
+            if glyph is not None:
+                self._glyphs.move_to_end(cache_key)
+                self.hits += 1
+                return glyph
+            self.misses += 1
+
+        font = self.font_registry.get(font_key, size)
+        with timed("glyph_rasterize"):
+            glyph = self._rasterize(font, stroke_width, ch)
+        glyph_bytes = glyph.mask.width * glyph.mask.height if glyph.mask is not None else 0
+
+        with self._lock:
+            if cache_key not in self._glyphs:
+                self._glyphs[cache_key] = glyph
+                self._used_bytes += glyph_bytes
+            while self._used_bytes > self.max_bytes and len(self._glyphs) > 1:
+                _, old = self._glyphs.popitem(last=False)
+                if old.mask is not None:
+                    self._used_bytes -= old.mask.width * old.mask.height
+                self.evictions += 1
+        return glyph
+
+    def clear(self):
+        with self._lock:
+            self._glyphs.clear()
+            self._used_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "glyphs": len(self._glyphs),
+                "bytes": self._used_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+GLYPH_CACHE = GlyphCache(GLYPH_CACHE_MAX_MB * 1024 * 1024, FONT_REGISTRY)
+
+
+def paste_glyph(image, glyph, x, y, fill):
+    """把缓存的字形按 draw.text 相同的位置合成到页面上"""
+    if glyph.mask is None:
+        return
+    image.paste(fill, (int(x) + glyph.offset_x, int(y) + glyph.offset_y), glyph.mask)
+
+
+# ========== 排版 ==========
+# A4纸尺寸 (300 DPI)
+PAGE_WIDTH, PAGE_HEIGHT = 2480, 3508
+PAGE_MARGIN = 160
+BG_COLOR = (255, 255, 255)
+TEXT_COLOR = (30, 30, 30)
+ERROR_MARK_COLOR = (128, 0, 0)
+MAX_PAGES = 50
+
+# 字体大小设置：小/中/大 -> (字号, 行高)
+FONT_SIZE_MODES = {
+    "small": (60, 84),
+    "medium": (80, 112),
+    "large": (100, 140),
+}
+
+# 常见的形近字，用于模拟手写错字
+SIMILAR_CHARS = {
+    '人': ['入', '八'],
+    '大': ['太', '犬'],
+    '木': ['本', '术'],
+    '日': ['曰', '田', '目'],
+    '己': ['已', '巳'],
+    '又': ['叉', '及'],
+    '白': ['百', '自'],
+    '有': ['友', '月'],
+    '问': ['间', '闲'],
+    '上': ['下', '土'],
+    '下': ['上', '土'],
+    '小': ['少', '小'],
+    '天': ['夫', '天'],
+    '王': ['玉', '王'],
+}
+CONFUSABLE_CHARS = ['日', '曰', '人', '入', '己', '已', '巳', '大', '太', '木', '本', '又', '叉', '自', '白', '有', '友', '月']
+
+RenderParams = namedtuple(
+    "RenderParams",
+    [
+        "text",
+        "font_key",
+        "font_weight",
+        "chars_per_line",
+        "lines_per_page",
+        "font_size_mode",
+        "enable_errors",
+        "jitter_level",
+        "seed",
+    ],
+)
+
+
+def parse_render_params(data, default_jitter=0):
+    """解析并校验 /api/render-image、/api/render-pdf 的请求参数
+
+    参数不合法时抛出 ValueError，异常信息可以直接返回给前端。
+    """
+    text = (data.get("text") or "").strip()
+    if not text:
+        raise ValueError("请输入文字")
+
+    chars_per_line = int(data.get("chars_per_line", 26))
+    lines_per_page = int(data.get("lines_per_page", 20))
+    if chars_per_line < 1 or chars_per_line > 100:
+        raise ValueError("每行字数必须在1-100之间")
+    if lines_per_page < 1 or lines_per_page > 50:
+        raise ValueError("每页行数必须在1-50之间")
+
+    font_size_mode = data.get("font_size_mode", "medium")  # 默认中等字体
+    if font_size_mode not in FONT_SIZE_MODES:
+        font_size_mode = "medium"
+
+    return RenderParams(
+        text=text,
+        font_key=data.get("font", "pingfang"),
+        font_weight=int(data.get("font_weight", 400)),
+        chars_per_line=chars_per_line,
+        lines_per_page=lines_per_page,
+        font_size_mode=font_size_mode,
+        enable_errors=bool(data.get("enable_errors", False)),  # 默认关闭错误功能
+        jitter_level=max(0, min(10, int(data.get("jitter_level", default_jitter)))),
+        seed=parse_seed(data),
+    )
+
+
+def parse_seed(data):
+    """可选的随机种子：指定后渲染结果完全确定，可以被缓存"""
+    seed = data.get("seed")
+    if seed is None:
+        return None
+    try:
+        return int(seed)
+    except (TypeError, ValueError):
+        raise ValueError("seed 必须是整数")
+
+
+def resolve_seed(params):
+    return params.seed if params.seed is not None else random.getrandbits(32)
+
+
+def stroke_width_for(font_weight):
+    """字体加粗：400 以上每 100 增加 1px 描边"""
+    return max(0, (font_weight - 400) // 100)
+
+
+def split_lines(text, chars_per_line):
+    """按每行字数切分文本，空段落保留为空行"""
+    logical_lines = []
+    with timed("split_lines"):
+        for para in text.split("\n"):
+            if not para.strip():
+                logical_lines.append("")
+                continue
+            para = para.strip()
+            while para:
+                logical_lines.append(para[:chars_per_line])
+                para = para[chars_per_line:]
+
+    if not logical_lines:
+        logical_lines = [""]
+    return logical_lines
+
+
+def estimate_pages(params):
+    """返回 (总行数, 页数)"""
+    total_lines = len(split_lines(params.text, params.chars_per_line))
+    return total_lines, (total_lines + params.lines_per_page - 1) // params.lines_per_page
+
+
+def paginate(logical_lines, lines_per_page):
+    """把逻辑行按每页行数分组"""
+    return [
+        logical_lines[idx : idx + lines_per_page]
+        for idx in range(0, len(logical_lines), lines_per_page)
+    ]
+
+
+class GlyphLayout:
+    """排版结果：按绘制顺序排列的定位字形记录
+
+    每条记录为 (page, x, y, glyph, color)，分别存放在紧凑的 array 中；
+    glyph/color 是 glyph_keys/colors 表中的下标，glyph_keys 的元素为
+    (char, size, stroke_width)。纠错划线存放在 marks 中，并记录它在
+    第几条字形记录之前绘制，以保持原有的叠放顺序。
+    """
+
+    def __init__(self, font_key, page_width, page_height):
+        self.font_key = FONT_REGISTRY.normalize_key(font_key)
+        self.page_width = page_width
+        self.page_height = page_height
+        self.num_pages = 0
+        self.page = array("H")
+        self.x = array("i")
+        self.y = array("i")
+        self.glyph = array("I")
+        self.color = array("B")
+        self.glyph_keys = []
+        self.colors = []
+        self.marks = []  # (page, at, (x0, y0, x1, y1), color_id)
+        self._glyph_ids = {}
+        self._color_ids = {}
+
+    def __len__(self):
+        return len(self.glyph)
+
+    def color_id(self, color):
+        color_id = self._color_ids.get(color)
+        if color_id is None:
+            color_id = self._color_ids[color] = len(self.colors)
+            self.colors.append(color)
+        return color_id
+
+    def glyph_id(self, ch, size, stroke_width):
+        glyph_key = (ch, size, stroke_width)
+        glyph_id = self._glyph_ids.get(glyph_key)
+        if glyph_id is None:
+            glyph_id = self._glyph_ids[glyph_key] = len(self.glyph_keys)
+            self.glyph_keys.append(glyph_key)
+        return glyph_id
+
+    def add_glyph(self, page, x, y, ch, size, stroke_width, color):
+        self.page.append(page)
+        self.x.append(int(x))
+        self.y.append(int(y))
+        self.glyph.append(self.glyph_id(ch, size, stroke_width))
+        self.color.append(self.color_id(color))
+
+    def add_glyphs(self, page, xs, ys, glyph_ids, color_ids):
+        """批量追加同一页的字形记录（NumPy 数组）"""
+        count = len(xs)
+        self.page.frombytes(np.full(count, page, dtype=np.uint16).tobytes())
+        self.x.frombytes(np.asarray(xs, dtype=np.int32).tobytes())
+        self.y.frombytes(np.asarray(ys, dtype=np.int32).tobytes())
+        self.glyph.frombytes(np.asarray(glyph_ids, dtype=np.uint32).tobytes())
+        self.color.frombytes(np.asarray(color_ids, dtype=np.uint8).tobytes())
+
+    def add_line(self, page, start, end, color):
+        self.marks.append((page, len(self.glyph), (*start, *end), self.color_id(color)))
+
+    def page_range(self, page):
+        """返回第 page 页字形记录的 [start, end) 下标"""
+        return bisect_left(self.page, page), bisect_left(self.page, page + 1)
+
+
+def layout_page(layout, page, lines, params, rng):
+    """排版一页文字，把字形记录追加到 layout 中
+
+    rng 为 numpy.random.Generator。所有随机抖动和效果开关都按页批量生成
+    （每种效果一次 NumPy 调用），位置用累加和一次算出；逐字的 Python 循环
+    只发生在被选中的少数字符（错字）和去重后的字符集上。
+    """
+    font_key = layout.font_key
+    font_size, line_height = FONT_SIZE_MODES[params.font_size_mode]
+    stroke_width = stroke_width_for(params.font_weight)
+    jitter_level = params.jitter_level
+    chars_per_line = params.chars_per_line
+    text_color = TEXT_COLOR
+
+    # 根据抖动强度计算抖动范围
+    # jitter_level=0 时无抖动，jitter_level=10 时最大抖动
+    line_v_range = jitter_level * 3  # 行垂直抖动: 0-30px
+    line_h_range = jitter_level * 4  # 行水平偏移: 0-40px
+    char_v_range = jitter_level * 2  # 字符垂直抖动: 0-20px
+    char_h_range = int(jitter_level * 1.5)  # 字符水平抖动: 0-15px
+
+    def symmetric(count, limit):
+        if limit <= 0:
+            return np.zeros(count, dtype=np.int64)
+        return rng.integers(-limit, limit + 1, count)
+
+    def sometimes(count, probability, values):
+        return np.where(rng.random(count) < probability, values, 0)
+
+    # 行距随机变化，超出页面底部的行不再绘制
+    n_lines = len(lines)
+    line_steps = line_height + rng.integers(-4, 5, n_lines)
+    line_tops = PAGE_MARGIN + np.cumsum(line_steps) - line_steps
+    n_lines = int(np.count_nonzero(line_tops <= layout.page_height - PAGE_MARGIN - line_height))
+    lines = lines[:n_lines]
+
+    # 8. 每行垂直位置随机抖动（模拟手写行间不对齐），以及字符级别的垂直抖动
+    base_ys = line_tops[:n_lines] + symmetric(n_lines, line_v_range) + symmetric(n_lines, char_v_range)
+    # 9. 每行左侧起始位置随机偏移（模拟手写左右不对齐）
+    start_xs = PAGE_MARGIN + symmetric(n_lines, line_h_range)
+
+    line_lengths = np.fromiter((len(line) for line in lines), dtype=np.int64, count=n_lines)
+    n_chars = int(line_lengths.sum())
+    if n_chars == 0:
+        return
+    char_lines = np.repeat(np.arange(n_lines), line_lengths)
+    codepoints = np.frombuffer("".join(lines).encode("utf-32-le"), dtype=np.uint32).copy()
+
+    # 随机引入错字 (约5%概率) - 仅当开启手写错误功能时
+    error_positions = []  # [(pos, correct_char), ...]
+    if params.enable_errors:
+        picks = rng.random(n_chars)
+        for pos in np.flatnonzero(rng.random(n_chars) < 0.05):
+            original_char = chr(codepoints[pos])
+            # 优先使用形近字，否则使用一些常见的易混淆字符
+            candidates = SIMILAR_CHARS.get(original_char, CONFUSABLE_CHARS)
+            codepoints[pos] = ord(candidates[int(picks[pos] * len(candidates))])
+            error_positions.append((pos, original_char))
+
+    # 字符水平抖动（根据抖动强度）
+    jitter_xs = symmetric(n_chars, char_h_range)
+    # 4. 偶尔添加轻微的字符大小变化 (4%概率)
+    size_deltas = sometimes(n_chars, 0.04, rng.integers(-2, 3, n_chars))
+    # 5. 偶尔添加轻微的笔画重写效果 (2%概率)
+    rewrites = np.flatnonzero(rng.random(n_chars) < 0.02)
+    rewrite_dx = rng.integers(-1, 2, rewrites.size)
+    rewrite_dy = rng.integers(-1, 2, rewrites.size)
+    # 6. 偶尔添加轻微的墨水不均匀效果 (3%概率)
+    inks = np.flatnonzero(rng.random(n_chars) < 0.03)
+    ink_variations = rng.integers(-20, 11, inks.size)
+    # 7. 偶尔模拟连笔效果 (1%概率，字符间距更紧密)
+    ligature_scale = np.where(rng.random(n_chars) < 0.01, rng.uniform(0.3, 0.8, n_chars), 1.0)
+
+    # 根据每行字数动态调整字间距：少字数更紧凑，多字数较窄但保持可读性
+    if chars_per_line <= 20:
+        extra_space = rng.integers(0, 4, n_chars)
+    elif chars_per_line <= 35:
+        extra_space = rng.integers(-1, 4, n_chars)
+    else:
+        extra_space = rng.integers(-2, 3, n_chars)
+    # 1. 偶尔添加轻微的字符倾斜 (5%概率)
+    tilt = sometimes(n_chars, 0.05, rng.integers(-2, 3, n_chars))
+    # 2. 偶尔添加轻微的字符重叠或间距异常 (3%概率)
+    extra_space += sometimes(n_chars, 0.03, rng.integers(-4, 5, n_chars))
+    # 3. 偶尔添加笔画抖动 (2%概率，根据抖动强度)
+    if jitter_level > 0:
+        stroke_jitter = sometimes(n_chars, 0.02, symmetric(n_chars, char_h_range * 2))
+    else:
+        stroke_jitter = 0
+
+    # 字宽只需按去重后的字符查询一次
+    unique_cps, char_ids = np.unique(codepoints, return_inverse=True)
+    unique_chars = [chr(cp) for cp in unique_cps]
+    unique_widths = np.array(
+        [GLYPH_CACHE.get(font_key, font_size, stroke_width, ch).width for ch in unique_chars],
+        dtype=np.int64,
+    )
+    widths = (unique_widths[char_ids] * ligature_scale).astype(np.int64)
+
+    # 每个字符的落笔位置 = 行首位置 + 本行之前所有字符的前进量
+    advances = widths + extra_space + tilt + stroke_jitter
+    before = np.cumsum(advances) - advances
+    line_starts = np.cumsum(line_lengths) - line_lengths
+    xs = start_xs[char_lines] + before - before[line_starts[char_lines]] + jitter_xs
+    ys = base_ys[char_lines]
+
+    # 主字形：字号变化后的字符不加粗
+    size_codes = char_ids * 5 + (size_deltas + 2)
+    unique_codes, code_ids = np.unique(size_codes, return_inverse=True)
+    code_glyph_ids = np.array(
+        [
+            layout.glyph_id(
+                unique_chars[code // 5],
+                font_size + code % 5 - 2,
+                stroke_width if code % 5 == 2 else 0,
+            )
+            for code in unique_codes
+        ],
+        dtype=np.uint32,
+    )
+    layout.add_glyphs(page, xs, ys, code_glyph_ids[code_ids], np.full(n_chars, layout.color_id(text_color)))
+
+    plain_glyph_ids = np.array([layout.glyph_id(ch, font_size, 0) for ch in unique_chars], dtype=np.uint32)
+
+    # 重写：稍微加深颜色并轻微错位
+    if rewrites.size:
+        darker_color = tuple(max(0, c - 30) for c in text_color)
+        layout.add_glyphs(
+            page,
+            xs[rewrites] + rewrite_dx,
+            ys[rewrites] + rewrite_dy,
+            plain_glyph_ids[char_ids[rewrites]],
+            np.full(rewrites.size, layout.color_id(darker_color)),
+        )
+
+    # 墨水不均匀：随机调整字符颜色深浅
+    if inks.size:
+        variation_color_ids = {
+            int(v): layout.color_id(tuple(max(0, min(255, c + int(v))) for c in text_color))
+            for v in np.unique(ink_variations)
+        }
+        layout.add_glyphs(
+            page,
+            xs[inks],
+            ys[inks],
+            plain_glyph_ids[char_ids[inks]],
+            np.fromiter((variation_color_ids[int(v)] for v in ink_variations), dtype=np.uint8, count=inks.size),
+        )
+
+    # 绘制错误纠正标记：斜线划掉错字，在旁边写上正确的字
+    for pos, correct_char in error_positions:
+        pos_x, pos_y = int(xs[pos]), int(ys[pos])
+        char_width = 20  # 估算字符宽度
+        layout.add_line(page, (pos_x, pos_y), (pos_x + char_width, pos_y + font_size), ERROR_MARK_COLOR)
+        layout.add_glyph(page, pos_x + char_width + 2, pos_y, correct_char, font_size, 0, text_color)
+
+
+def page_ids(pages):
+    """每页的稳定标识：页面文字的哈希 + 相同内容在文档中第几次出现
+
+    随机效果按页面标识而不是页码生成，修改某一段后，内容没变的页面
+    即使前后移动，渲染结果也保持不变，可以直接复用。
+    """
+    seen = {}
+    ids = []
+    for lines in pages:
+        digest = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()[:32]
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        ids.append(f"{digest}:{occurrence}")
+    return ids
+
+
+def page_rng(seed, page_id):
+    """每页独立的随机数生成器，保证并行/串行渲染结果一致"""
+    return np.random.default_rng(random.Random(f"{seed}:{page_id}").getrandbits(128))
+
+
+def layout_document(params, seed):
+    """把整篇文字排版为 A4 页面上的字形记录"""
+    layout = GlyphLayout(params.font_key, PAGE_WIDTH, PAGE_HEIGHT)
+    pages = paginate(split_lines(params.text, params.chars_per_line), params.lines_per_page)[:MAX_PAGES]
+    for page, (lines, page_id) in enumerate(zip(pages, page_ids(pages))):
+        with timed("layout"):
+            layout_page(layout, page, lines, params, page_rng(seed, page_id))
+    layout.num_pages = len(pages)
+    return layout
+
+
+def layout_single_page(params, page_id, lines, seed):
+    """单独排版文档中的一页（结果中页码为 0）"""
+    layout = GlyphLayout(params.font_key, PAGE_WIDTH, PAGE_HEIGHT)
+    with timed("layout"):
+        layout_page(layout, 0, lines, params, page_rng(seed, page_id))
+    layout.num_pages = 1
+    return layout
+
+
+def layout_region(text, font_key, font_size, stroke_width, jitter_level, width, height, rng=random):
+    """排版 PDF 编辑区域内的文字（按区域宽度自动换行）"""
+    layout = GlyphLayout(font_key, width, height)
+    layout.num_pages = 1
+    text_color = TEXT_COLOR
+    current_x = 5
+    current_y = 5
+
+    # 计算抖动范围
+    char_h_range = int(jitter_level * 1.5)
+    char_v_range = jitter_level * 2
+
+    for char in text:
+        if char == '\n':
+            current_x = 5
+            current_y += int(font_size * 1.2)
+            continue
+
+        # 字符抖动
+        jitter_x = rng.randint(-char_h_range, char_h_range) if char_h_range > 0 else 0
+        jitter_y = rng.randint(-char_v_range, char_v_range) if char_v_range > 0 else 0
+
+        layout.add_glyph(0, current_x + jitter_x, current_y + jitter_y, char, font_size, stroke_width, text_color)
+        current_x += GLYPH_CACHE.get(layout.font_key, font_size, stroke_width, char).width + rng.randint(-1, 2)
+
+        # 换行检查
+        if current_x > width - font_size:
+            current_x = 5
+            current_y += int(font_size * 1.2)
+
+    return layout
+
+
+# ========== 光栅化 ==========
+# 整页渲染使用单通道 L 画布：墨迹颜色都是灰阶，只有错字标记是彩色的，
+# 彩色标记在编码时再叠加，内存只有 RGB 画布的 1/3
+PageRaster = namedtuple("PageRaster", ["image", "marks"])  # marks: [(coords, rgb)]
+
+
+def gray_level(color):
+    """RGB 颜色对应的灰度值（与 PIL convert("L") 的公式一致）"""
+    r, g, b = color[:3]
+    return (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+
+
+def is_gray(color):
+    return color[0] == color[1] == color[2]
+
+
+def rasterize_page(layout, page, mode="RGB", background=BG_COLOR, overlay=None, scale=1):
+    """把排版结果中的一页合成为 PIL 图片
+
+    mode 为 L 时颜色按灰度绘制；传入 overlay 列表时彩色标记不画到画布上，
+    而是以 (coords, rgb) 追加到 overlay 中。scale 不为 1 时按比例缩小输出
+    （预览用），字形位置由原排版坐标直接换算，字号按比例取整。
+    """
+    canvas_size = (round(layout.page_width * scale), round(layout.page_height * scale))
+    image = Image.new(mode, canvas_size, background)
+    glyphs = [
+        GLYPH_CACHE.get(layout.font_key, max(1, round(size * scale)), round(stroke * scale), ch)
+        for ch, size, stroke in layout.glyph_keys
+    ]
+    if mode == "RGBA":
+        fills = [color + (255,) for color in layout.colors]
+    elif mode == "L":
+        fills = [gray_level(color) for color in layout.colors]
+    else:
+        fills = layout.colors
+
+    marks = [mark for mark in layout.marks if mark[0] == page]
+    if scale != 1:
+        marks = [(p, at, tuple(c * scale for c in coords), color_id) for p, at, coords, color_id in marks]
+    if overlay is not None:
+        overlay.extend((coords, layout.colors[color_id]) for _, _, coords, color_id in marks
+                       if not is_gray(layout.colors[color_id]))
+        marks = [mark for mark in marks if is_gray(layout.colors[mark[3]])]
+    draw = ImageDraw.Draw(image) if marks else None
+    mark_idx = 0
+
+    xs, ys, glyph_ids, color_ids = layout.x, layout.y, layout.glyph, layout.color
+    start, end = layout.page_range(page)
+    for i in range(start, end):
+        while mark_idx < len(marks) and marks[mark_idx][1] <= i:
+            _, _, coords, color_id = marks[mark_idx]
+            draw.line(coords, fill=fills[color_id], width=1)
+            mark_idx += 1
+        paste_glyph(image, glyphs[glyph_ids[i]], xs[i] * scale, ys[i] * scale, fills[color_ids[i]])
+
+    for _, _, coords, color_id in marks[mark_idx:]:
+        draw.line(coords, fill=fills[color_id], width=1)
+    return image
+
+
+def rasterize_page_gray(layout, page):
+    """整页渲染：返回 L 画布和待叠加的彩色标记"""
+    overlay = []
+    image = rasterize_page(layout, page, mode="L", background=gray_level(BG_COLOR), overlay=overlay)
+    return PageRaster(image, overlay)
+
+
+def raster_to_rgb(raster):
+    image = raster.image.convert("RGB")
+    if raster.marks:
+        draw = ImageDraw.Draw(image)
+        for coords, color in raster.marks:
+            draw.line(coords, fill=color, width=1)
+    return image
+
+
+def raster_to_gray(raster):
+    """彩色标记按灰度画进画布（直接修改 raster.image）"""
+    if raster.marks:
+        draw = ImageDraw.Draw(raster.image)
+        for coords, color in raster.marks:
+            draw.line(coords, fill=gray_level(color), width=1)
+    return raster.image
+
+
+# PNG 颜色模式：rgb 原样输出；gray 为 8 位灰度（错字标记变为灰色）；
+# palette 为 16 色调色板（灰阶 + 错字标记色）；bw 为 1 位黑白
+PNG_COLOR_MODES = ("rgb", "gray", "palette", "bw")
+# 速度/体积档位 -> zlib 压缩级别
+PNG_COMPRESS_PROFILES = {"fast": 1, "balanced": 6, "small": 9}
+PngOptions = namedtuple("PngOptions", ["color", "profile"])
+DEFAULT_PNG_OPTIONS = PngOptions("rgb", "balanced")
+
+# 调色板：前 15 项为 0-255 均匀分布的灰阶，最后一项为错字标记色；
+# 灰度画布按查表直接得到调色板下标，不需要做颜色量化
+_PALETTE_GRAY_LEVELS = 15
+_PALETTE_MARK_INDEX = _PALETTE_GRAY_LEVELS
+_PNG_PALETTE = [
+    c for i in range(_PALETTE_GRAY_LEVELS) for c in (round(i * 255 / (_PALETTE_GRAY_LEVELS - 1)),) * 3
+] + list(ERROR_MARK_COLOR)
+_GRAY_TO_PALETTE = [round(v * (_PALETTE_GRAY_LEVELS - 1) / 255) for v in range(256)]
+_BW_THRESHOLD = [0] * 128 + [255] * 128
+
+
+def parse_png_options(data):
+    """解析 png_color / png_profile 参数，不合法时抛出 ValueError"""
+    color = data.get("png_color", DEFAULT_PNG_OPTIONS.color)
+    if color not in PNG_COLOR_MODES:
+        raise ValueError(f"png_color 必须是 {'/'.join(PNG_COLOR_MODES)} 之一")
+    profile = data.get("png_profile", DEFAULT_PNG_OPTIONS.profile)
+    if profile not in PNG_COMPRESS_PROFILES:
+        raise ValueError(f"png_profile 必须是 {'/'.join(PNG_COMPRESS_PROFILES)} 之一")
+    return PngOptions(color, profile)
+
+
+def raster_to_palette(raster):
+    image = raster.image.point(_GRAY_TO_PALETTE).convert("P")
+    image.putpalette(_PNG_PALETTE)
+    if raster.marks:
+        draw = ImageDraw.Draw(image)
+        for coords, _ in raster.marks:
+            draw.line(coords, fill=_PALETTE_MARK_INDEX, width=1)
+    return image
+
+
+def convert_for_png(raster, color):
+    if color == "gray":
+        return raster_to_gray(raster)
+    if color == "palette":
+        return raster_to_palette(raster)
+    if color == "bw":
+        return raster_to_gray(raster).point(_BW_THRESHOLD, "1")
+    return raster_to_rgb(raster)
+
+
+def encode_png(raster, options=DEFAULT_PNG_OPTIONS):
+    buffer = BytesIO()
+    with timed("encode_png"):
+        image = convert_for_png(raster, options.color)
+        image.save(buffer, format="PNG", dpi=(300, 300), compress_level=PNG_COMPRESS_PROFILES[options.profile])
+    return buffer.getvalue()
+
+
+def png_encoder(options):
+    """返回可以传给渲染进程池的编码函数"""
+    if options == DEFAULT_PNG_OPTIONS:
+        return encode_png
+    return functools.partial(encode_png, options=options)
+
+
+def encode_jpeg_page(raster):
+    """把页面编码为 PDF 内嵌用的 JPEG；没有彩色标记的页面直接以灰度 JPEG 写入"""
+    buffer = BytesIO()
+    with timed("encode_jpeg"):
+        image = raster_to_rgb(raster) if raster.marks else raster.image
+        image.save(buffer, format="JPEG")
+    return buffer.getvalue(), image.size, image.mode
+
+
+# 预览图格式 -> (PIL 格式, mimetype)
+PREVIEW_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+PREVIEW_MIN_DPI, PREVIEW_MAX_DPI = 36, 150
+PreviewOptions = namedtuple("PreviewOptions", ["dpi", "format", "quality", "pages"])
+
+
+def parse_preview_options(data):
+    """解析 /api/preview 的 dpi / format / quality / pages 参数，不合法时抛出 ValueError"""
+    dpi = int(data.get("dpi", 72))
+    if dpi < PREVIEW_MIN_DPI or dpi > PREVIEW_MAX_DPI:
+        raise ValueError(f"dpi 必须在{PREVIEW_MIN_DPI}-{PREVIEW_MAX_DPI}之间")
+    fmt = data.get("format", "webp")
+    if fmt not in PREVIEW_FORMATS:
+        raise ValueError("format 必须是 webp 或 jpeg")
+    quality = int(data.get("quality", 75))
+    if quality < 1 or quality > 100:
+        raise ValueError("quality 必须在1-100之间")
+    pages = data.get("pages")
+    if pages is not None:
+        if not isinstance(pages, list) or not pages:
+            raise ValueError("pages 必须是非空的页码列表")
+        try:
+            pages = [int(page) for page in pages]
+        except (TypeError, ValueError):
+            raise ValueError("pages 中的页码必须是整数")
+    return PreviewOptions(dpi, fmt, quality, pages)
+
+
+def encode_preview(image, fmt, quality):
+    buffer = BytesIO()
+    with timed("encode_preview"):
+        image.save(buffer, format=PREVIEW_FORMATS[fmt][0], quality=quality)
+    return buffer.getvalue()
+
+
+# ========== 流式输出 ==========
+class StreamBuffer:
+    """只写缓冲区：zipfile/PDF 写入这里，生成器每写完一页就取走已写入的数据"""
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class StreamingPdfWriter:
+    """逐页写出 PDF，每页是一张铺满页面的 JPEG 图片
+
+    对象编号：1 为 Catalog，2 为 Pages，之后每页依次占用图片、内容流、页面三个对象；
+    Pages 和 xref 在 close() 时写出，因此每页写完即可释放。
+    """
+
+    def __init__(self, fp, dpi=300):
+        self.fp = fp
+        self.dpi = dpi
+        self._offsets = {}
+        self._page_ids = []
+        self._next_id = 3
+        self.fp.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write_object(self, obj_id, body, stream=None):
+        self._offsets[obj_id] = self.fp.tell()
+        self.fp.write(f"{obj_id} 0 obj\n".encode())
+        self.fp.write(body.encode())
+        if stream is not None:
+            self.fp.write(b"\nstream\n")
+            self.fp.write(stream)
+            self.fp.write(b"\nendstream")
+        self.fp.write(b"\nendobj\n")
+
+    def add_jpeg_page(self, jpeg_bytes, size, mode):
+        width, height = size
+        page_w = width * 72.0 / self.dpi
+        page_h = height * 72.0 / self.dpi
+        color_space = "DeviceGray" if mode == "L" else "DeviceRGB"
+        image_id, content_id, page_id = self._next_id, self._next_id + 1, self._next_id + 2
+        self._next_id += 3
+
+        self._write_object(
+            image_id,
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace /{color_space} /BitsPerComponent 8 /Filter /DCTDecode "
+            f"/Length {len(jpeg_bytes)} >>",
+            jpeg_bytes,
+        )
+        content = f"q {page_w:.2f} 0 0 {page_h:.2f} 0 0 cm /image Do Q".encode()
+        self._write_object(content_id, f"<< /Length {len(content)} >>", content)
+        self._write_object(
+            page_id,
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:.2f} {page_h:.2f}] "
+            f"/Resources << /XObject << /image {image_id} 0 R >> >> /Contents {content_id} 0 R >>",
+        )
+        self._page_ids.append(page_id)
+
+    def close(self):
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self._write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>")
+        self._write_object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_offset = self.fp.tell()
+        self.fp.write(f"xref\n0 {self._next_id}\n0000000000 65535 f \n".encode())
+        for obj_id in range(1, self._next_id):
+            self.fp.write(f"{self._offsets[obj_id]:010d} 00000 n \n".encode())
+        self.fp.write(f"trailer\n<< /Size {self._next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+
+def zip_entry(name):
+    """固定时间戳的 ZIP 条目（存储不压缩），相同内容的 ZIP 每次字节一致，ETag 才可靠"""
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = 0o600 << 16
+    return info
+
+
+def stream_png_zip(params, seed, progress=None, png=DEFAULT_PNG_OPTIONS):
+    """逐页渲染、编码并写入 ZIP，每页写完立即输出；progress(已完成页数) 用于汇报进度
+
+    PNG 本身已经 deflate 压缩，ZIP 中直接存储，不再二次压缩。
+    """
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+        for i, png_bytes in enumerate(iter_rendered_pages(params, seed, encoder=png_encoder(png)), start=1):
+            with timed("zip"):
+                zf.writestr(zip_entry(f"handwritten_page_{i:03d}.png"), png_bytes)
+            if progress:
+                progress(i)
+            yield buffer.drain()
+    yield buffer.drain()
+    print(f"✓ ZIP大小: {buffer.size} bytes")
+
+
+def stream_pdf(params, seed, progress=None):
+    """逐页渲染并写入 PDF，每页写完立即输出；progress(已完成页数) 用于汇报进度"""
+    buffer = StreamBuffer()
+    writer = StreamingPdfWriter(buffer)
+    for i, page in enumerate(iter_rendered_pages(params, seed, encoder=encode_jpeg_page), start=1):
+        with timed("pdf_write"):
+            writer.add_jpeg_page(*page)
+        if progress:
+            progress(i)
+        yield buffer.drain()
+    writer.close()
+    yield buffer.drain()
+    print(f"✓ PDF生成完成，大小: {buffer.size} bytes")
+
+
+def logged_stream(chunks, label):
+    """流式响应中出错时无法再返回 JSON，只能记录日志并中断连接"""
+    try:
+        yield from chunks
+        print(f"字体缓存: {FONT_REGISTRY.stats()}")
+        print(f"字形缓存: {GLYPH_CACHE.stats()}")
+        print(f"========== {label}请求处理成功 ==========\n")
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        print(f"========== {label}请求处理失败 ==========\n")
+        raise
+
+
+def attachment_response(chunks, mimetype, download_name):
+    return Response(
+        chunks,
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={download_name}"},
+    )
+
+
+# ========== 矢量PDF ==========
+def supports_vector_pdf(font_key):
+    """MuPDF 无法正确嵌入 CFF 轮廓的 OpenType 字体（OTTO），这类字体只能光栅化"""
+    font_file = FONT_REGISTRY.font_file(font_key)
+    return font_file is not None and font_file.kind == "truetype"
+
+
+def render_vector_pdf(layout):
+    """把排版结果写成矢量 PDF：每个字形作为真实文字放置，字体嵌入并子集化
+
+    坐标与光栅化完全一致（300 DPI 像素按 72/300 换算为 pt），PIL 以字形上沿
+    （ascender）定位，PDF 以基线定位，因此 y 需要加上对应字号的 ascender。
+    加粗用描边渲染模式近似。
+    """
+    scale = 72.0 / 300
+    pdf_font = fitz.Font(fontfile=FONT_REGISTRY.font_file(layout.font_key).path)
+    ascents = {}
+    colors = [tuple(c / 255 for c in color) for color in layout.colors]
+
+    doc = fitz.open()
+    for page_no in range(layout.num_pages):
+        page = doc.new_page(width=layout.page_width * scale, height=layout.page_height * scale)
+        writers = {}  # (color_id, 是否加粗) -> TextWriter
+        start, end = layout.page_range(page_no)
+        for i in range(start, end):
+            ch, size, stroke_width = layout.glyph_keys[layout.glyph[i]]
+            if ch.isspace():
+                continue
+            if size not in ascents:
+                ascents[size] = FONT_REGISTRY.get(layout.font_key, size).getmetrics()[0]
+            writer_key = (layout.color[i], stroke_width > 0)
+            writer = writers.get(writer_key)
+            if writer is None:
+                writer = writers[writer_key] = fitz.TextWriter(page.rect)
+            writer.append(
+                ((layout.x[i]) * scale, (layout.y[i] + ascents[size]) * scale),
+                ch,
+                font=pdf_font,
+                fontsize=size * scale,
+            )
+
+        for (color_id, bold), writer in writers.items():
+            writer.write_text(page, color=colors[color_id], render_mode=2 if bold else 0)
+
+        for mark_page, _, (x0, y0, x1, y1), color_id in layout.marks:
+            if mark_page == page_no:
+                page.draw_line((x0 * scale, y0 * scale), (x1 * scale, y1 * scale), color=colors[color_id], width=scale)
+
+    doc.subset_fonts()
+    pdf_bytes = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return pdf_bytes
+
+
+# ========== 多进程分页渲染 ==========
+# 渲染进程数，0/1 表示关闭（默认），多页文档会按页分发到进程池
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "0"))
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def prewarm_fonts():
+    """预先加载所有可用字体的常用字号"""
+    for font_key in AVAILABLE_FONTS:
+        if not FONT_REGISTRY.is_available(font_key):
+            continue
+        for font_size, _ in FONT_SIZE_MODES.values():
+            FONT_REGISTRY.get(font_key, font_size)
+
+
+# 启动预热用的常用字，覆盖常见文本中的大部分字形
+WARMUP_CHARS = (
+    "的一是不了人我在有他这中大来上个们到说国和地也子时道出而要于就下得可你年生自会那后能对着事"
+    "其里所去行过家十用发天如然作方成者多日都三小军二无同么经法当起与好看学进种将还分此心前面又定"
+    "见只主没公从知使，。、！？：；“”（）0123456789"
+)
+
+
+def warm_caches():
+    """预热字体、常用字形和编码器（gunicorn master 在 fork worker 之前调用）"""
+    start = time.perf_counter()
+    prewarm_fonts()
+    for font_key in AVAILABLE_FONTS:
+        if not FONT_REGISTRY.is_available(font_key):
+            continue
+        for font_size, _ in FONT_SIZE_MODES.values():
+            for ch in WARMUP_CHARS:
+                GLYPH_CACHE.get(font_key, font_size, 0, ch)
+
+    # 走一遍排版、光栅化和编码，提前完成 NumPy/PIL 的初始化
+    params = parse_render_params({"text": WARMUP_CHARS, "font": FONT_REGISTRY.fallback_key})
+    for encoder in (encode_png, encode_jpeg_page):
+        next(iter_rendered_pages(params, 0, encoder=encoder))
+
+    # 预热产生的耗时不计入指标
+    STAGE_SECONDS.reset()
+    print(f"✓ 缓存预热完成，耗时 {time.perf_counter() - start:.2f}s，字形缓存: {GLYPH_CACHE.stats()}")
+
+
+def _init_render_worker():
+    """进程池初始化：预先加载所有字体的常用字号"""
+    prewarm_fonts()
+
+
+# 启动时预热字体（配合 gunicorn preload，worker fork 前完成）
+if os.environ.get("FONT_PREWARM", "0") == "1":
+    prewarm_fonts()
+
+
+def get_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            print(f"启动渲染进程池: {RENDER_WORKERS} 个进程")
+            # 不用 fork：池在请求中才创建，此时其他线程（请求、后台任务）可能正持有
+            # 字体或字形缓存的锁，fork 出的子进程会永远等在这把锁上。子进程在
+            # _init_render_worker 中自行加载字体，不依赖继承的状态
+            _render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_init_render_worker,
+            )
+        return _render_pool
+
+
+def render_page_task(params, page_id, lines, seed, encoder=None):
+    """排版并光栅化一页；encoder 不为空时返回编码后的字节（在子进程中完成编码）"""
+    layout = layout_single_page(params, page_id, lines, seed)
+    with timed("rasterize"):
+        raster = rasterize_page_gray(layout, 0)
+    return encoder(raster) if encoder else raster
+
+
+def _pooled_render_page_task(params, page_id, lines, seed, encoder=None):
+    """子进程中的指标无法直接汇总，把各阶段耗时随结果一起返回"""
+    with record_stages() as timings:
+        result = render_page_task(params, page_id, lines, seed, encoder)
+    return result, timings
+
+
+def _collect_pooled_result(future):
+    result, timings = future.result()
+    for stage, seconds in timings.items():
+        observe_stage(stage, seconds)
+    return result
+
+
+def iter_rendered_pages(params, seed, encoder=None):
+    """按页序逐页产出渲染结果，开启 RENDER_WORKERS 时多页文档并行渲染
+
+    指定了 seed 的请求结果确定，编码后的页面按内容写入页面缓存，
+    再次导出时只重新渲染内容有变化的页面。
+    """
+    pages = paginate(split_lines(params.text, params.chars_per_line), params.lines_per_page)[:MAX_PAGES]
+    ids = page_ids(pages)
+    use_cache = encoder is not None and params.seed is not None and PAGE_CACHE.enabled
+    parallel = RENDER_WORKERS > 1 and len(pages) > 1
+    reused = 0
+
+    def finish(entry):
+        key, result = entry
+        if isinstance(result, Future):
+            result = _collect_pooled_result(result)
+        if key:
+            # 缓存写入失败（磁盘满、并发淘汰等）只记录，不影响渲染
+            try:
+                store_cached_page(key, result)
+            except OSError as e:
+                print(f"⚠️ 页面缓存写入失败: {e}")
+        return result
+
+    # 按页序排队的 (待写入缓存的 key, 结果或 Future)；
+    # 并行时最多提前提交 2 倍进程数的页面，避免结果在内存中堆积
+    pending = deque()
+    for page, (lines, page_id) in enumerate(zip(pages, ids)):
+        key = page_cache_key(params, page_id, seed, encoder) if use_cache else None
+        result = load_cached_page(key) if key else None
+        if result is not None:
+            reused += 1
+            pending.append((None, result))
+        elif parallel:
+            pending.append((key, get_render_pool().submit(_pooled_render_page_task, params, page_id, lines, seed, encoder)))
+        else:
+            print(f"  生成第 {page + 1} 页...")
+            pending.append((key, render_page_task(params, page_id, lines, seed, encoder)))
+
+        while pending and (
+            not parallel or not isinstance(pending[0][1], Future) or len(pending) >= RENDER_WORKERS * 2
+        ):
+            yield finish(pending.popleft())
+    while pending:
+        yield finish(pending.popleft())
+
+    if use_cache:
+        print(f"✓ 页面缓存: 复用 {reused}/{len(pages)} 页")
+
+
+# ========== 异步任务 ==========
+# 任务数据库和结果文件目录，多个 gunicorn worker 共享
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "handwriting-jobs"))
+# 每个进程的后台渲染线程数
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# 任务及结果保留时间（秒）
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", str(24 * 3600)))
+# 进程定时刷新自己任务的 updated_at 作为心跳；queued/running 任务超过 JOB_STALE_SECONDS
+# 没有心跳（worker 被回收、重启或崩溃）即标记为失败
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", "10"))
+JOB_STALE_SECONDS = float(os.environ.get("JOB_STALE_SECONDS", "60"))
+
+JOB_OUTPUTS = {
+    # output -> (默认抖动强度, 多页 mimetype, 多页文件名)
+    "image": (0, "application/zip", "handwritten_pages.zip"),
+    "pdf": (6, "application/pdf", "handwritten_pages.pdf"),
+}
+
+
+class JobStore:
+    """基于 SQLite 的任务状态存储，结果文件保存在同一目录下"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.db_path = os.path.join(directory, "jobs.sqlite3")
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    output TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    total_pages INTEGER NOT NULL,
+                    done_pages INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    result_path TEXT,
+                    mimetype TEXT,
+                    download_name TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    owner_pid INTEGER
+                )
+                """
+            )
+            # 旧版本创建的数据库没有 owner_pid 列
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner_pid" not in columns:
+                try:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+                except sqlite3.OperationalError:
+                    pass  # 其他 worker 已经添加
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, output, total_pages):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, output, status, total_pages, created_at, updated_at, owner_pid) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, output, total_pages, now, now, os.getpid()),
+            )
+        return job_id
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def result_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.out")
+
+    def heartbeat(self, owner_pid):
+        """刷新本进程所有未完成任务的 updated_at"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET updated_at = ? WHERE owner_pid = ? AND status IN ('queued', 'running')",
+                (time.time(), owner_pid),
+            )
+
+    def fail_stale(self, stale_seconds, job_id=None):
+        """把所属进程已退出、或超过 stale_seconds 没有心跳的 queued/running 任务标记为失败
+
+        渲染参数不落库，无法重新排队，只能让客户端重新提交。返回被标记的任务ID。
+        """
+        cutoff = time.time() - stale_seconds
+        query = "SELECT id, owner_pid, updated_at FROM jobs WHERE status IN ('queued', 'running')"
+        args = ()
+        if job_id is not None:
+            query += " AND id = ?"
+            args = (job_id,)
+        with self._connect() as conn:
+            rows = conn.execute(query, args).fetchall()
+            stale = [row["id"] for row in rows if row["updated_at"] < cutoff or not process_alive(row["owner_pid"])]
+            for stale_id in stale:
+                # 带状态条件，避免覆盖刚好完成的任务
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? "
+                    "WHERE id = ? AND status IN ('queued', 'running')",
+                    ("任务中断（处理进程已退出），请重新提交", time.time(), stale_id),
+                )
+        for stale_id in stale:
+            part_path = self.result_path(stale_id) + ".part"
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            print(f"⚠️ [任务 {stale_id}] 处理进程已退出或心跳超时，标记为失败")
+        return stale
+
+    def purge_expired(self, ttl_seconds):
+        """删除过期任务及其结果文件"""
+        cutoff = time.time() - ttl_seconds
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, result_path FROM jobs WHERE updated_at < ?", (cutoff,)).fetchall()
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,))
+        for row in rows:
+            if row["result_path"] and os.path.exists(row["result_path"]):
+                os.remove(row["result_path"])
+
+
+def process_alive(pid):
+    """同一台机器上 pid 对应的进程是否还在（没有记录 pid 的旧任务视为存活，只按心跳判断）"""
+    if pid is None or pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_job_store = None
+_job_pool = None
+_job_lock = threading.Lock()
+
+
+def get_job_store():
+    global _job_store
+    with _job_lock:
+        if _job_store is None:
+            _job_store = JobStore(JOBS_DIR)
+            # 启动时回收之前的进程留下的未完成任务
+            _job_store.fail_stale(JOB_STALE_SECONDS)
+        return _job_store
+
+
+def _job_heartbeat_loop(store):
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            store.heartbeat(os.getpid())
+        except sqlite3.Error as e:
+            print(f"⚠️ 任务心跳失败: {e}")
+
+
+def get_job_pool():
+    global _job_pool
+    store = get_job_store()
+    with _job_lock:
+        if _job_pool is None:
+            _job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="render-job")
+            threading.Thread(target=_job_heartbeat_loop, args=(store,), name="job-heartbeat", daemon=True).start()
+        return _job_pool
+
+
+def render_to_file(path, output, params, seed, total_pages, png=DEFAULT_PNG_OPTIONS, progress=None):
+    """把一个文档渲染到文件（单页图片为 PNG，多页为 ZIP，pdf 为 PDF），返回 (mimetype, 文件名)"""
+    _, mimetype, download_name = JOB_OUTPUTS[output]
+    if output == "image" and total_pages == 1:
+        chunks = [next(iter_rendered_pages(params, seed, encoder=png_encoder(png)))]
+        if progress:
+            progress(1)
+        mimetype, download_name = "image/png", "handwritten_page_1.png"
+    elif output == "image":
+        chunks = stream_png_zip(params, seed, progress, png)
+    else:
+        chunks = stream_pdf(params, seed, progress)
+
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return mimetype, download_name
+
+
+def run_render_job(store, job_id, output, params, seed, total_pages, png=DEFAULT_PNG_OPTIONS):
+    """后台线程：渲染到临时文件，完成后原子替换为结果文件"""
+    # 与同步请求共用渲染额度，额度不足时任务保持 queued 状态
+    ticket = ADMISSION.acquire(render_cost(params, output, total_pages), background=True)
+    print(f"[任务 {job_id}] 开始渲染，共 {total_pages} 页")
+    store.update(job_id, status="running")
+    result_path = store.result_path(job_id)
+    part_path = result_path + ".part"
+
+    def progress(done_pages):
+        store.update(job_id, done_pages=done_pages)
+
+    try:
+        mimetype, download_name = render_to_file(part_path, output, params, seed, total_pages, png, progress)
+        os.replace(part_path, result_path)
+
+        store.update(
+            job_id,
+            status="done",
+            result_path=result_path,
+            mimetype=mimetype,
+            download_name=download_name,
+        )
+        print(f"[任务 {job_id}] ✓ 渲染完成")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        store.update(job_id, status="failed", error=str(e))
+        print(f"[任务 {job_id}] ✗ 渲染失败: {e}")
+    finally:
+        ticket.release()
+
+
+# ========== 批量渲染 ==========
+# 单次批量请求最多的文档数，以及同时渲染的文档数（同一进程内共享字体和字形缓存）
+BATCH_MAX_DOCUMENTS = int(os.environ.get("BATCH_MAX_DOCUMENTS", "500"))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "4"))
+
+
+def parse_batch_lines(text):
+    """解析 JSONL（每行一个文档），返回 [(序号, 文档)]；无法解析的行文档为 ValueError"""
+    documents = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            document = json.loads(line)
+            if not isinstance(document, dict):
+                raise ValueError("每行必须是一个 JSON 对象")
+        except ValueError as e:
+            document = ValueError(f"JSON 解析失败: {e}")
+        documents.append((len(documents) + 1, document))
+    return documents
+
+
+def render_batch_document(index, document, directory):
+    """把一个文档渲染到 directory 下的临时文件，返回清单条目（含临时文件路径 path）"""
+    start = time.perf_counter()
+    is_document = isinstance(document, dict)
+    doc_id = str(document.get("id", index)) if is_document else str(index)
+    entry = {"index": index, "id": doc_id, "status": "failed"}
+    try:
+        if not is_document:
+            raise document
+        output = document.get("output", "image")
+        entry["output"] = output
+        if output not in JOB_OUTPUTS:
+            raise ValueError("output 必须是 image 或 pdf")
+        params = parse_render_params(document, default_jitter=JOB_OUTPUTS[output][0])
+        png = parse_png_options(document)
+        _, total_pages = estimate_pages(params)
+        if total_pages > MAX_PAGES:
+            raise ValueError(f"文本过长，请分批处理（最多{MAX_PAGES}页）")
+
+        seed = resolve_seed(params)
+        path = os.path.join(directory, f"{index}.part")
+        ticket = ADMISSION.acquire(render_cost(params, output, total_pages), background=True)
+        try:
+            _, download_name = render_to_file(path, output, params, seed, total_pages, png)
+        finally:
+            ticket.release()
+        safe_id = re.sub(r"[^\w.-]", "_", doc_id)[:64]
+        entry.update(
+            status="ok",
+            file=f"{index:04d}_{safe_id}{os.path.splitext(download_name)[1]}",
+            pages=total_pages,
+            seed=seed,
+            bytes=os.path.getsize(path),
+            path=path,
+        )
+    except ValueError as e:
+        entry["error"] = str(e)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        entry["error"] = f"生成失败: {str(e)}"
+    entry["seconds"] = round(time.perf_counter() - start, 3)
+    mark = "✓" if entry["status"] == "ok" else "✗"
+    print(f"  {mark} 文档 {index} ({doc_id}): {entry['seconds']}s {entry.get('error', '')}")
+    return entry
+
+
+def stream_batch_archive(documents, workers=BATCH_WORKERS):
+    """并发渲染多个文档，按完成顺序写入一个 ZIP 并流式输出，最后写入 manifest.json"""
+    start = time.perf_counter()
+    buffer = StreamBuffer()
+    manifest = []
+    with tempfile.TemporaryDirectory(prefix="handwriting-batch-") as directory, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as pool, \
+            zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+        futures = [pool.submit(render_batch_document, index, document, directory) for index, document in documents]
+        try:
+            for future in as_completed(futures):
+                entry = future.result()
+                path = entry.pop("path", None)
+                if path:
+                    # 各文档输出本身已经压缩，直接存储；分块拷贝，边写边输出
+                    with open(path, "rb") as src, zf.open(zip_entry(entry["file"]), "w") as dest:
+                        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                            dest.write(chunk)
+                            yield buffer.drain()
+                    os.remove(path)
+                manifest.append(entry)
+                yield buffer.drain()
+        finally:
+            # 客户端中途断开时不再渲染尚未开始的文档
+            for future in futures:
+                future.cancel()
+
+        manifest.sort(key=lambda entry: entry["index"])
+        failed = sum(1 for entry in manifest if entry["status"] != "ok")
+        zf.writestr(zip_entry("manifest.json"), json.dumps({
+            "documents": len(manifest),
+            "failed": failed,
+            "seconds": round(time.perf_counter() - start, 3),
+            "results": manifest,
+        }, ensure_ascii=False, indent=2))
+    yield buffer.drain()
+    print(f"✓ 批量渲染完成: {len(manifest) - failed}/{len(manifest)} 个文档成功，ZIP大小: {buffer.size} bytes")
+
+
+# ========== 渲染结果缓存 ==========
+# 只缓存指定了 seed 的请求（结果确定）；RENDER_CACHE_MAX_MB=0 关闭磁盘缓存
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "handwriting-render-cache"))
+RENDER_CACHE_MAX_MB = int(os.environ.get("RENDER_CACHE_MAX_MB", "512"))
+# 超过这个时间（秒）没有写入的 .part 文件视为中断遗留，淘汰时删除
+RENDER_CACHE_PART_TTL = 600
+# 渲染逻辑变化导致输出不同时递增，使旧缓存失效
+RENDER_CACHE_VERSION = 6
+
+CachedRender = namedtuple("CachedRender", ["path", "mimetype", "download_name"])
+
+
+def render_cache_key(output, params, png=None):
+    """规范化请求的内容哈希，同时用作 ETag"""
+    payload = {"version": RENDER_CACHE_VERSION, "output": output, **params._asdict()}
+    if png is not None:
+        payload["png"] = png._asdict()
+    normalized = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """按内容哈希存放渲染结果的磁盘缓存
+
+    每个条目是结果文件 <key>.bin 加元数据 <key>.json，
+    命中时更新文件修改时间，超出容量时按修改时间淘汰最久未用的条目。
+    目录由所有 worker 共享，文件随时可能被其他进程淘汰，删除和读取都要容忍文件已不存在。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".bin", base + ".json"
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # 已被其他进程删除
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            os.utime(data_path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedRender(data_path, meta["mimetype"], meta["download_name"])
+
+    def store(self, key, chunks, mimetype, download_name):
+        """边输出边写入缓存；生成器被完整消费后才提交缓存条目"""
+        if not self.enabled:
+            yield from chunks
+            return
+
+        data_path, meta_path = self._paths(key)
+        part_path = f"{data_path}.{uuid.uuid4().hex}.part"
+        committed = False
+        try:
+            with open(part_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"mimetype": mimetype, "download_name": download_name}, f)
+            os.replace(part_path, data_path)
+            committed = True
+        finally:
+            if not committed:
+                self._remove(part_path)
+        self.evict()
+
+    def put(self, key, data, mimetype, download_name):
+        for _ in self.store(key, [data], mimetype, download_name):
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        part_cutoff = time.time() - RENDER_CACHE_PART_TTL
+        for name in os.listdir(self.directory):
+            is_part = name.endswith(".part")
+            if not is_part and not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if is_part:
+                # 写入中途进程退出留下的临时文件；正在写入的计入容量但不删除
+                if stat.st_mtime < part_cutoff:
+                    self._remove(path)
+                else:
+                    total += stat.st_size
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[: -len(".bin")]))
+            total += stat.st_size
+
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, key = entries.pop(0)
+            for path in self._paths(key):
+                self._remove(path)
+            total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "max_bytes": self.max_bytes}
+
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_MB * 1024 * 1024)
+
+# 单页缓存：按 (页面文字, 排版参数, 页面随机种子, 编码方式) 存放编码后的页面，0 表示关闭
+PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "handwriting-page-cache"))
+PAGE_CACHE_MAX_MB = int(os.environ.get("PAGE_CACHE_MAX_MB", "256"))
+PAGE_CACHE = RenderCache(PAGE_CACHE_DIR, PAGE_CACHE_MAX_MB * 1024 * 1024)
+
+
+def encoder_tag(encoder):
+    """编码器的缓存标识，参数不同的同一编码函数标识不同"""
+    if isinstance(encoder, functools.partial):
+        return f"{encoder.func.__name__}:{sorted(encoder.keywords.items())}"
+    return encoder.__name__
+
+
+def page_cache_key(params, page_id, seed, encoder):
+    payload = {
+        "version": RENDER_CACHE_VERSION,
+        "page": page_id,
+        "seed": seed,
+        "encoder": encoder_tag(encoder),
+        **params._replace(text="", seed=None)._asdict(),
+    }
+    normalized = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def load_cached_page(key):
+    cached = PAGE_CACHE.get(key)
+    if cached is None:
+        return None
+    try:
+        with open(cached.path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if cached.mimetype == "image/jpeg":
+        # PDF 页面的编码结果是 (JPEG 字节, 尺寸, 颜色模式)，尺寸和模式从文件头读取
+        image = Image.open(BytesIO(data))
+        return data, image.size, image.mode
+    return data
+
+
+def store_cached_page(key, result):
+    if isinstance(result, tuple):
+        PAGE_CACHE.put(key, result[0], "image/jpeg", "page.jpg")
+    else:
+        PAGE_CACHE.put(key, result, "image/png", "page.png")
+
+
+def send_cached_render(cached, cache_key):
+    """发送缓存的结果；条目在 get() 之后已被其他进程淘汰时返回 None，由调用方重新渲染"""
+    try:
+        data = open(cached.path, "rb")
+    except FileNotFoundError:
+        return None
+    print(f"✓ 命中渲染缓存: {cache_key[:12]}")
+    return send_file(
+        data,
+        mimetype=cached.mimetype,
+        as_attachment=True,
+        download_name=cached.download_name,
+        etag=cache_key,
+    )
+
+
+def not_modified(cache_key):
+    print(f"✓ ETag 未变化: {cache_key[:12]}")
+    response = Response(status=304)
+    response.set_etag(cache_key)
+    return response
+
+
+# ========== 请求性能分析 ==========
+# 仅用于排查：开启后请求带 ?profile=1 时在 cProfile 下处理，并保存分析结果和请求内容
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "handwriting-profiles"))
+
+
+def save_request_payload(profile_id):
+    """保存请求内容（JSON 按键排序，上传的文件另存），用于离线重放"""
+    record = {
+        "id": profile_id,
+        "endpoint": request.endpoint,
+        "path": request.path,
+        "json": None,
+        "form": {},
+        "files": {},
+    }
+    if request.is_json:
+        record["json"] = json.loads(json.dumps(request.get_json(silent=True) or {}, sort_keys=True))
+    else:
+        record["form"] = {key: request.form[key] for key in sorted(request.form)}
+        for field, upload in request.files.items():
+            file_name = f"{profile_id}.{field}"
+            upload.save(os.path.join(PROFILE_DIR, file_name))
+            upload.stream.seek(0)
+            record["files"][field] = {"path": file_name, "filename": upload.filename}
+    return record
+
+
+def profiled(view):
+    """对带 ?profile=1 的请求做 cProfile 分析（需开启 PROFILING_ENABLED）"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not PROFILING_ENABLED or request.args.get("profile") != "1":
+            return view(*args, **kwargs)
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{uuid.uuid4().hex[:8]}"
+        record = save_request_payload(profile_id)
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            response = app.make_response(view(*args, **kwargs))
+            # 流式响应的渲染在生成器中进行，分析时整体缓冲以便计入
+            if response.is_streamed and not response.direct_passthrough:
+                response.make_sequence()
+        finally:
+            profiler.disable()
+        record["elapsed"] = time.perf_counter() - start
+        record["status"] = response.status_code
+
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{profile_id}.prof"))
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+        print(f"✓ 性能分析已保存: {profile_id}（耗时 {record['elapsed']:.2f}s）")
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    return wrapper
+
+
+# ========== 准入控制 ==========
+# 每个进程同时渲染的成本上限（单位：中号字的整页图片），以及排队的请求数和最长等待秒数
+ADMISSION_PAGE_BUDGET = float(os.environ.get("ADMISSION_PAGE_BUDGET", "60"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "16"))
+ADMISSION_WAIT_SECONDS = float(os.environ.get("ADMISSION_WAIT_SECONDS", "15"))
+# 各输出类型每页的相对成本
+ADMISSION_OUTPUT_WEIGHTS = {"image": 1.0, "pdf": 1.0, "pdf-vector": 0.3}
+
+
+def render_cost(params, output, pages):
+    """按页数、字号和输出类型估算渲染成本"""
+    font_size = FONT_SIZE_MODES[params.font_size_mode][0]
+    return pages * ADMISSION_OUTPUT_WEIGHTS[output] * font_size / FONT_SIZE_MODES["medium"][0]
+
+
+class AdmissionTicket:
+    def __init__(self, controller, cost):
+        self.controller = controller
+        self.cost = cost
+        self.start = time.perf_counter()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller.release(self)
+
+
+class AdmissionController:
+    """进程级准入控制
+
+    正在渲染的请求成本之和不超过 budget；超出时请求排队等待，
+    队列已满或等待超时则拒绝（由调用方返回 429）。单个请求的成本超过
+    budget 时按 budget 计，保证它仍能在空闲时单独运行。
+    """
+
+    def __init__(self, budget, max_queue, wait_seconds):
+        self.budget = budget
+        self.max_queue = max_queue
+        self.wait_seconds = wait_seconds
+        self._cond = threading.Condition()
+        self.in_use = 0.0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        # 每单位成本的平均耗时（指数滑动平均），用于计算 Retry-After
+        self.seconds_per_unit = 1.0
+
+    def acquire(self, cost, background=False):
+        """申请额度，返回 AdmissionTicket，被拒绝时返回 None
+
+        background 为 True（异步任务、批量渲染）时不占用排队名额，一直等到有额度为止。
+        """
+        cost = min(cost, self.budget)
+        with self._cond:
+            if self.waiting and not background or self.in_use + cost > self.budget:
+                if not background and self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    return None
+                if not background:
+                    self.waiting += 1
+                try:
+                    admitted = self._cond.wait_for(
+                        lambda: self.in_use + cost <= self.budget,
+                        None if background else self.wait_seconds,
+                    )
+                finally:
+                    if not background:
+                        self.waiting -= 1
+                if not admitted:
+                    self.rejected += 1
+                    return None
+            self.in_use += cost
+            self.admitted += 1
+            return AdmissionTicket(self, cost)
+
+    def release(self, ticket):
+        elapsed = time.perf_counter() - ticket.start
+        with self._cond:
+            self.in_use = max(0.0, self.in_use - ticket.cost)
+            if ticket.cost > 0:
+                self.seconds_per_unit = 0.8 * self.seconds_per_unit + 0.2 * elapsed / ticket.cost
+            self._cond.notify_all()
+
+    def retry_after(self):
+        """估算多少秒后会有空闲额度"""
+        with self._cond:
+            return max(1, min(60, math.ceil(self.in_use * self.seconds_per_unit / 2)))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "in_use": self.in_use,
+                "budget": self.budget,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+ADMISSION = AdmissionController(ADMISSION_PAGE_BUDGET, ADMISSION_QUEUE_SIZE, ADMISSION_WAIT_SECONDS)
+
+
+def admit_request(cost):
+    """为当前请求申请渲染额度；响应（包括流式输出）结束时自动释放"""
+    ticket = ADMISSION.acquire(cost)
+    if ticket is not None:
+        g.admission_ticket = ticket
+    return ticket
+
+
+def over_capacity():
+    retry_after = ADMISSION.retry_after()
+    print(f"⚠️ 服务器繁忙，拒绝请求（{ADMISSION.stats()}），{retry_after}s 后重试")
+    response = jsonify({"error": "服务器繁忙，请稍后重试"})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@app.after_request
+def hand_off_admission(response):
+    # 流式响应在输出完毕（或客户端断开）后才释放额度；send_file 等
+    # direct_passthrough 响应不会执行 call_on_close，且内容已生成，直接释放
+    ticket = g.pop("admission_ticket", None)
+    if ticket is None:
+        return response
+    if response.is_streamed and not response.direct_passthrough:
+        response.call_on_close(ticket.release)
+    else:
+        ticket.release()
+    return response
+
+
+@app.teardown_request
+def release_admission(exc):
+    # 没有生成响应（未捕获的异常）时直接释放
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        ticket.release()
+
+
+# ========== PDF上传 ==========
+# 上传的 PDF 先分块写入临时文件再按路径打开，MuPDF 只解析实际用到的页面；
+# 编辑结果也写入临时文件后发送，整份 PDF 不会在内存中出现多份
+PDF_UPLOAD_MAX_MB = float(os.environ.get("PDF_UPLOAD_MAX_MB", "200"))
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", "2000"))
+PDF_SPOOL_DIR = os.environ.get("PDF_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "handwriting-pdf-uploads"))
+PDF_SPOOL_CHUNK = 1024 * 1024
+# 请求体总大小上限 = PDF 上限 + 余量（截图等其它表单部分），超出时 Werkzeug 在解析表单前直接返回 413，
+# 不会先把整个请求体写进临时文件；spool_pdf_upload 仍单独检查 PDF 部分的大小
+UPLOAD_HEADROOM_MB = float(os.environ.get("UPLOAD_HEADROOM_MB", "50"))
+app.config["MAX_CONTENT_LENGTH"] = int((PDF_UPLOAD_MAX_MB + UPLOAD_HEADROOM_MB) * 1024 * 1024)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] / 1024 / 1024
+    return jsonify({"error": f"请求体过大（最大{limit_mb:g}MB）"}), 413
+
+# 保存方式：incremental 把修改追加到原文件末尾，原有页面内容原样保留；full 重写整个文档
+PDF_SAVE_MODES = ("incremental", "full")
+# garbage: 0-4 清理未引用对象的程度；deflate: 压缩新写入的流；deflate_images / deflate_fonts:
+# 同时压缩未压缩的图片/字体；object_streams: 把对象打包进压缩的对象流。garbage 和 object_streams 只用于 full
+PdfSaveOptions = namedtuple(
+    "PdfSaveOptions", ["mode", "garbage", "deflate", "deflate_images", "deflate_fonts", "object_streams"]
+)
+DEFAULT_PDF_SAVE_OPTIONS = PdfSaveOptions(
+    os.environ.get("PDF_SAVE_MODE", "incremental"), 0, True, True, False, False
+)
+
+
+def spool_pdf_upload(upload):
+    """把上传的 PDF 分块写入临时文件，同时检查大小和文件头，返回文件路径"""
+    os.makedirs(PDF_SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=PDF_SPOOL_DIR)
+    limit = PDF_UPLOAD_MAX_MB * 1024 * 1024
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = upload.stream.read(PDF_SPOOL_CHUNK)
+                if not chunk:
+                    break
+                if size == 0 and b"%PDF-" not in chunk[:1024]:
+                    raise ValueError("上传的文件不是PDF")
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError(f"PDF文件过大（最大{PDF_UPLOAD_MAX_MB:g}MB）")
+                f.write(chunk)
+        if size == 0:
+            raise ValueError("上传的PDF文件为空")
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def parse_pdf_save_options(data):
+    """解析 pdf_save / pdf_garbage / pdf_deflate 等保存参数，不合法时抛出 ValueError"""
+    defaults = DEFAULT_PDF_SAVE_OPTIONS
+    mode = data.get("pdf_save", defaults.mode)
+    if mode not in PDF_SAVE_MODES:
+        raise ValueError(f"pdf_save 必须是 {'/'.join(PDF_SAVE_MODES)} 之一")
+    try:
+        garbage = int(data.get("pdf_garbage", defaults.garbage))
+    except (TypeError, ValueError):
+        raise ValueError("pdf_garbage 必须是整数")
+    if not 0 <= garbage <= 4:
+        raise ValueError("pdf_garbage 必须在0-4之间")
+    object_streams = bool(data.get("pdf_object_streams", defaults.object_streams))
+    if mode == "incremental" and (garbage or object_streams):
+        raise ValueError("增量保存不支持 pdf_garbage / pdf_object_streams")
+    return PdfSaveOptions(
+        mode,
+        garbage,
+        bool(data.get("pdf_deflate", defaults.deflate)),
+        bool(data.get("pdf_deflate_images", defaults.deflate_images)),
+        bool(data.get("pdf_deflate_fonts", defaults.deflate_fonts)),
+        object_streams,
+    )
+
+
+@contextmanager
+def uploaded_pdf(upload):
+    """预检并打开上传的 PDF（加密、页数），退出时关闭文档并删除临时文件"""
+    path = spool_pdf_upload(upload)
+    try:
+        with timed("pdf_open"):
+            doc = fitz.open(path, filetype="pdf")
+        try:
+            if doc.needs_pass:
+                raise ValueError("PDF已加密，请先移除密码")
+            if doc.page_count > PDF_MAX_PAGES:
+                raise ValueError(f"PDF页数过多（最多{PDF_MAX_PAGES}页）")
+            print(f"PDF页数: {doc.page_count}，大小: {os.path.getsize(path)} bytes")
+            yield doc
+        finally:
+            doc.close()
+    finally:
+        # 增量保存时文件已交给响应发送，这里可能已被删除
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def save_edited_pdf(doc, options):
+    """按保存选项写出编辑结果，返回结果文件路径（增量保存时就是上传的临时文件）"""
+    if options.mode == "incremental":
+        if doc.can_save_incrementally():
+            with timed("pdf_save"):
+                doc.save(
+                    doc.name,
+                    incremental=True,
+                    encryption=fitz.PDF_ENCRYPT_KEEP,
+                    deflate=options.deflate,
+                    deflate_images=options.deflate_images,
+                    deflate_fonts=options.deflate_fonts,
+                )
+            return doc.name
+        print("⚠️ 该PDF无法增量保存（可能已损坏被修复），改为完整保存")
+
+    os.makedirs(PDF_SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=PDF_SPOOL_DIR)
+    os.close(fd)
+    try:
+        with timed("pdf_save"):
+            doc.save(
+                path,
+                garbage=options.garbage,
+                deflate=options.deflate,
+                deflate_images=options.deflate_images,
+                deflate_fonts=options.deflate_fonts,
+                use_objstms=int(options.object_streams),
+            )
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def send_pdf_document(doc, download_name, options=DEFAULT_PDF_SAVE_OPTIONS):
+    """保存编辑后的文档并发送；打开后立即删除目录项，句柄关闭（响应结束）时释放磁盘空间"""
+    path = save_edited_pdf(doc, options)
+    print(f"✓ PDF编辑完成（{options.mode}），大小: {os.path.getsize(path)} bytes")
+    output = open(path, "rb")
+    os.remove(path)
+    return send_file(
+        output,
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name=download_name,
+    )
 
 
 @app.route("/")
@@ -39,10 +2261,34 @@ def index():
 @app.get("/api/fonts")
 def get_fonts():
     fonts_list = [
-        {"key": key, "name": info["name"], "cssFamily": info["css_family"]}
+        {
+            "key": key,
+            "name": info["name"],
+            "cssFamily": info["css_family"],
+            "available": FONT_REGISTRY.is_available(key),
+            "vectorPdf": supports_vector_pdf(key) if FONT_REGISTRY.is_available(key) else False,
+        }
         for key, info in AVAILABLE_FONTS.items()
     ]
-    return jsonify({"fonts": fonts_list})
+    return jsonify({"fonts": fonts_list, "fallback": FONT_REGISTRY.fallback_key})
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus 文本格式的各阶段耗时直方图（每个进程单独统计）"""
+    lines = STAGE_SECONDS.render() + REQUEST_SECONDS.render()
+    admission = ADMISSION.stats()
+    lines += [
+        "# TYPE handwriting_admission_in_use gauge",
+        f"handwriting_admission_in_use {admission['in_use']}",
+        "# TYPE handwriting_admission_budget gauge",
+        f"handwriting_admission_budget {admission['budget']}",
+        "# TYPE handwriting_admission_waiting gauge",
+        f"handwriting_admission_waiting {admission['waiting']}",
+        "# TYPE handwriting_admission_rejected_total counter",
+        f"handwriting_admission_rejected_total {admission['rejected']}",
+    ]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
 
 
 @app.post("/api/convert")
@@ -53,381 +2299,81 @@ def convert_text():
 
 
 @app.post("/api/render-image")
+@profiled
 def render_image():
     print("\n========== 开始处理图片生成请求 ==========")
     
     try:
-        # 获取请求数据
+        # 获取并校验参数
         data = request.get_json() or {}
-        text = (data.get("text") or "").strip()
-        
-        if not text:
-            print("错误: 文本为空")
-            return jsonify({"error": "请输入文字"}), 400
-        
-        print(f"文本长度: {len(text)} 字符")
-        
-        # 获取参数
-        font_key = data.get("font", "pingfang")
-        font_weight = int(data.get("font_weight", 400))
-        chars_per_line = int(data.get("chars_per_line", 26))
-        lines_per_page = int(data.get("lines_per_page", 20))
-        font_size_mode = data.get("font_size_mode", "medium")  # 默认中等字体
-        enable_errors = data.get("enable_errors", False)  # 默认关闭错误功能
-        jitter_level = int(data.get("jitter_level", 0))  # 抖动强度，默认0（无抖动）
-        
-        # 限制抖动强度范围
-        jitter_level = max(0, min(10, jitter_level))
-        
-        # 参数验证
-        if chars_per_line < 1 or chars_per_line > 100:
-            print(f"错误: 每行字数({chars_per_line})超出范围")
-            return jsonify({"error": "每行字数必须在1-100之间"}), 400
+        try:
+            params = parse_render_params(data, default_jitter=0)  # 抖动强度，默认0（无抖动）
+            png = parse_png_options(data)
+        except ValueError as e:
+            print(f"错误: {e}")
+            return jsonify({"error": str(e)}), 400
         
-        if lines_per_page < 1 or lines_per_page > 50:
-            print(f"错误: 每页行数({lines_per_page})超出范围")
-            return jsonify({"error": "每页行数必须在1-50之间"}), 400
+        print(f"文本长度: {len(params.text)} 字符")
         
         # 智能警告（只记录，不阻止）
-        if chars_per_line > 35:
-            print(f"⚠️ 警告: 每行{chars_per_line}字可能超出A4纸宽度，建议20-30字")
-        
-        if lines_per_page > 28:
-            print(f"⚠️ 警告: 每页{lines_per_page}行可能超出A4纸高度，建议15-25行")
-        
-        print(f"参数: 字体={font_key}, 粗细={font_weight}, 每行={chars_per_line}字, 每页={lines_per_page}行, 字体大小模式={font_size_mode}")
-        
-        # A4纸尺寸 (300 DPI)
-        width, height = 2480, 3508
-        margin = 160
-        bg_color = (255, 255, 255)
-        text_color = (30, 30, 30)
-        
-        # 字体大小设置：小/中/大
-        if font_size_mode == "small":
-            font_size = 60
-            line_height = 84
-            print(f"字体大小: 小 ({font_size}pt)")
-        elif font_size_mode == "large":
-            font_size = 100
-            line_height = 140
-            print(f"字体大小: 大 ({font_size}pt)")
-        else:  # medium 默认
-            font_size = 80
-            line_height = 112
-            print(f"字体大小: 中 ({font_size}pt)")
-        
-        # 字体加粗
-        stroke_width = max(0, (font_weight - 400) // 100)
-        
-        # 加载字体
-        font_path = get_font_path(font_key)
-        print(f"字体路径: {font_path}")
-        print(f"字体文件存在: {os.path.exists(font_path)}")
+        if params.chars_per_line > 35:
+            print(f"⚠️ 警告: 每行{params.chars_per_line}字可能超出A4纸宽度，建议20-30字")
         
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-            print("✓ 字体加载成功")
-        except Exception as e:
-            print(f"✗ 字体加载失败: {e}")
-            print("使用默认字体")
-            font = ImageFont.load_default()
-        
-        # 切分文本为行
-        logical_lines = []
-        for para in text.split("\n"):
-            if not para.strip():
-                logical_lines.append("")
-                continue
-            para = para.strip()
-            while para:
-                logical_lines.append(para[:chars_per_line])
-                para = para[chars_per_line:]
+        if params.lines_per_page > 28:
+            print(f"⚠️ 警告: 每页{params.lines_per_page}行可能超出A4纸高度，建议15-25行")
         
-        if not logical_lines:
-            logical_lines = [""]
+        print(f"参数: 字体={params.font_key}, 粗细={params.font_weight}, 每行={params.chars_per_line}字, 每页={params.lines_per_page}行, 字体大小模式={params.font_size_mode}")
+        print(f"PNG输出: 颜色={png.color}, 压缩档位={png.profile}")
         
-        total_lines = len(logical_lines)
-        estimated_pages = (total_lines + lines_per_page - 1) // lines_per_page
+        # 限制最大页数
+        total_lines, estimated_pages = estimate_pages(params)
         print(f"总行数: {total_lines}, 预计页数: {estimated_pages}")
         
-        # 限制最大页数
-        MAX_PAGES = 50
         if estimated_pages > MAX_PAGES:
             print(f"页数超限: {estimated_pages} > {MAX_PAGES}")
             return jsonify({"error": f"文本过长，请分批处理（最多{MAX_PAGES}页）"}), 400
         
-        # 生成图片
-        pages = []
-        idx = 0
-        
-        while idx < total_lines and len(pages) < MAX_PAGES:
-            page_num = len(pages) + 1
-            print(f"  生成第 {page_num} 页...")
-            
-            image = Image.new("RGB", (width, height), color=bg_color)
-            draw = ImageDraw.Draw(image)
-            current_y = margin
-            
-            lines_this_page = logical_lines[idx : idx + lines_per_page]
-            
-            for line_idx, line in enumerate(lines_this_page):
-                if current_y > height - margin - line_height:
-                    break
-                
-                # 根据抖动强度计算抖动范围
-                # jitter_level=0 时无抖动，jitter_level=10 时最大抖动
-                line_v_range = jitter_level * 3  # 行垂直抖动: 0-30px
-                line_h_range = jitter_level * 4  # 行水平偏移: 0-40px
-                char_v_range = jitter_level * 2  # 字符垂直抖动: 0-20px
-                char_h_range = int(jitter_level * 1.5)  # 字符水平抖动: 0-15px
-                
-                # 8. 每行垂直位置随机抖动（模拟手写行间不对齐）
-                line_vertical_jitter = random.randint(-line_v_range, line_v_range) if line_v_range > 0 else 0
-                base_y = current_y + line_vertical_jitter
-                
-                # 字符级别的垂直抖动
-                jitter_y = random.randint(-char_v_range, char_v_range) if char_v_range > 0 else 0
-                
-                # 9. 每行左侧起始位置随机偏移（模拟手写左右不对齐）
-                line_horizontal_jitter = random.randint(-line_h_range, line_h_range) if line_h_range > 0 else 0
-                x = margin + line_horizontal_jitter
-                
-                # 绘制当前行的文本，添加错字和纠正标记
-                processed_chars = list(line)
-                error_positions = []  # 记录错误位置 [(pos, correct_char, wrong_char), ...]
-                
-                # 随机引入错字 (约5%概率) - 仅当开启手写错误功能时
-                if enable_errors:
-                    for i in range(len(processed_chars)):
-                        if random.random() < 0.05:  # 5%概率
-                            original_char = processed_chars[i]
-                            
-                            # 生成相似的错字
-                            similar_chars = {
-                                '人': ['入', '八'],
-                                '大': ['太', '犬'],
-                                '木': ['本', '术'],
-                                '日': ['曰', '田', '目'],
-                                '己': ['已', '巳'],
-                                '又': ['叉', '及'],
-                                '白': ['百', '自'],
-                                '有': ['友', '月'],
-                                '问': ['间', '闲'],
-                                '上': ['下', '土'],
-                                '下': ['上', '土'],
-                                '小': ['少', '小'],
-                                '天': ['夫', '天'],
-                                '王': ['玉', '王'],
-                            }
-                            
-                            if original_char in similar_chars:
-                                wrong_char = random.choice(similar_chars[original_char])
-                            else:
-                                # 使用一些常见的易混淆字符
-                                wrong_char = random.choice(['日', '曰', '人', '入', '己', '已', '巳', '大', '太', '木', '本', '又', '叉', '自', '白', '有', '友', '月'])
-                            
-                            processed_chars[i] = wrong_char
-                            error_positions.append((i, original_char, wrong_char))
-                
-                # 绘制字符
-                char_coords = []  # 记录每个字符的坐标
-                for ch_idx, ch in enumerate(processed_chars):
-                    # 字符水平抖动（根据抖动强度）
-                    jitter_x = random.randint(-char_h_range, char_h_range) if char_h_range > 0 else 0
-                    
-                    # 添加更多手写真实感效果
-                    # 4. 偶尔添加轻微的字符大小变化
-                    if random.random() < 0.04:  # 4%概率
-                        # 随机调整字符大小
-                        temp_font_size = font_size + random.randint(-2, 2)
-                        if temp_font_size != font_size:
-                            try:
-                                temp_font = ImageFont.truetype(font_path, temp_font_size)
-                                draw.text(
-                                    (x + jitter_x, base_y + jitter_y), 
-                                    ch, 
-                                    fill=text_color, 
-                                    font=temp_font
-                                )
-                            except:
-                                temp_font = ImageFont.load_default()
-                                draw.text(
-                                    (x + jitter_x, base_y + jitter_y), 
-                                    ch, 
-                                    fill=text_color, 
-                                    font=temp_font
-                                )
-                        else:
-                            if stroke_width > 0:
-                                draw.text(
-                                    (x + jitter_x, base_y + jitter_y), 
-                                    ch, 
-                                    fill=text_color, 
-                                    font=font,
-                                    stroke_width=stroke_width,
-                                    stroke_fill=text_color
-                                )
-                            else:
-                                draw.text(
-                                    (x + jitter_x, base_y + jitter_y), 
-                                    ch, 
-                                    fill=text_color, 
-                                    font=font
-                                )
-                    else:
-                        if stroke_width > 0:
-                            draw.text(
-                                (x + jitter_x, base_y + jitter_y), 
-                                ch, 
-                                fill=text_color, 
-                                font=font,
-                                stroke_width=stroke_width,
-                                stroke_fill=text_color
-                            )
-                        else:
-                            draw.text(
-                                (x + jitter_x, base_y + jitter_y), 
-                                ch, 
-                                fill=text_color, 
-                                font=font
-                            )
-                    
-                    # 记录字符坐标用于错误纠正
-                    char_coords.append((x + jitter_x, base_y + jitter_y))
-                    
-                    # 5. 偶尔添加轻微的笔画重写效果（模拟重写）
-                    if random.random() < 0.02:  # 2%概率
-                        # 稍微加深颜色，模拟重写效果
-                        darker_color = tuple(min(255, c - 30) for c in text_color) if isinstance(text_color, tuple) else (30, 30, 30)
-                        draw.text(
-                            (x + jitter_x + random.randint(-1, 1), base_y + jitter_y + random.randint(-1, 1)), 
-                            ch, 
-                            fill=darker_color, 
-                            font=font
-                        )
-                                        
-                    # 6. 偶尔添加轻微的墨水不均匀效果
-                    if random.random() < 0.03:  # 3%概率
-                        # 随机调整字符颜色深浅
-                        color_variation = random.randint(-20, 10)
-                        varied_color = tuple(max(0, min(255, c + color_variation)) for c in text_color) if isinstance(text_color, tuple) else text_color
-                        draw.text(
-                            (x + jitter_x, base_y + jitter_y), 
-                            ch, 
-                            fill=varied_color, 
-                            font=font
-                        )
-                                        
-                    # 7. 偶尔模拟连笔效果（字符间距变化）
-                    if random.random() < 0.01:  # 1%概率
-                        # 模拟连笔，字符间距更紧密
-                        char_spacing_multiplier = random.uniform(0.3, 0.8)
-                        w = w * char_spacing_multiplier
-                                        
-                    try:
-                        bbox = draw.textbbox((0, 0), ch, font=font)
-                        w = bbox[2] - bbox[0]
-                    except AttributeError:
-                        w, _ = draw.textsize(ch, font=font)
-                                    
-                    # 根据每行字数动态调整字间距
-                    if chars_per_line <= 20:
-                        # 少字数：较窄的字间距，更紧凑
-                        extra_space = random.randint(0, 3)
-                    elif chars_per_line <= 35:
-                        # 中等字数：适中的字间距
-                        extra_space = random.randint(-1, 3)
-                    else:
-                        # 多字数：较窄的字间距，但保持可读性
-                        extra_space = random.randint(-2, 2)
-                                    
-                    # 添加人为小错误以增加真实感
-                    # 1. 偶尔添加轻微的字符倾斜
-                    if random.random() < 0.05:  # 5%概率
-                        # 创建一个小的倾斜效果
-                        tilt_offset = random.randint(-2, 2)
-                        x += tilt_offset
-                                        
-                    # 2. 偶尔添加轻微的字符重叠或间距异常
-                    if random.random() < 0.03:  # 3%概率
-                        # 随机增加或减少间距
-                        extra_space += random.randint(-4, 4)
-                                        
-                    # 3. 偶尔添加笔画抖动
-                    if jitter_level > 0 and random.random() < 0.02:  # 2%概率
-                        # 模拟手写时的轻微抖动（根据抖动强度）
-                        stroke_jitter = random.randint(-char_h_range * 2, char_h_range * 2) if char_h_range > 0 else 0
-                        x += stroke_jitter
-                                    
-                    x += w + extra_space
-                
-                # 绘制错误纠正标记
-                for pos, correct_char, wrong_char in error_positions:
-                    if pos < len(char_coords):
-                        pos_x, pos_y = char_coords[pos]
-                        
-                        # 绘制斜线划掉错字
-                        char_width = 20  # 估算字符宽度
-                        char_height = font_size
-                        
-                        # 绘制斜线
-                        line_start = (pos_x, pos_y)
-                        line_end = (pos_x + char_width, pos_y + char_height)
-                        draw.line([line_start, line_end], fill=(128, 0, 0), width=1)
-                        
-                        # 在旁边写上正确的字
-                        correct_char_x = pos_x + char_width + 2
-                        draw.text(
-                            (correct_char_x, pos_y), 
-                            correct_char, 
-                            fill=text_color, 
-                            font=font
-                        )
-
-                current_y += line_height + random.randint(-4, 4)
-            
-            pages.append(image)
-            idx += lines_per_page
-        
-        print(f"✓ 总共生成 {len(pages)} 页")
-        
-        # 返回结果
-        if len(pages) == 1:
-            print("保存单页PNG...")
-            buffer = BytesIO()
-            pages[0].save(buffer, format="PNG", dpi=(300, 300))
-            buffer.seek(0)
-            print(f"✓ 文件大小: {len(buffer.getvalue())} bytes")
+        # 指定 seed 的请求结果确定，可以使用 ETag 和渲染缓存
+        seed = resolve_seed(params)
+        cache_key = render_cache_key("image", params, png) if params.seed is not None else None
+        if cache_key:
+            if request.if_none_match.contains(cache_key):
+                return not_modified(cache_key)
+            cached = RENDER_CACHE.get(cache_key)
+            response = send_cached_render(cached, cache_key) if cached else None
+            if response is not None:
+                return response
+        
+        if admit_request(render_cost(params, "image", estimated_pages)) is None:
+            return over_capacity()
+        
+        # 排版 + 生成图片（每页在渲染进程中直接编码为PNG）
+        if estimated_pages == 1:
+            png_bytes = next(iter_rendered_pages(params, seed, encoder=png_encoder(png)))
+            print(f"✓ 文件大小: {len(png_bytes)} bytes")
             print("========== 请求处理成功 ==========\n")
             
-            return send_file(
-                buffer,
-                mimetype="image/png",
+            mimetype, download_name = "image/png", "handwritten_page_1.png"
+            if cache_key:
+                RENDER_CACHE.put(cache_key, png_bytes, mimetype, download_name)
+            response = send_file(
+                BytesIO(png_bytes),
+                mimetype=mimetype,
                 as_attachment=True,
-                download_name="handwritten_page_1.png",
+                download_name=download_name,
             )
-        
-        print("打包多页ZIP...")
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            for i, img in enumerate(pages, start=1):
-                img_bytes = BytesIO()
-                img.save(img_bytes, format="PNG", dpi=(300, 300))
-                img_bytes.seek(0)
-                filename = f"handwritten_page_{i:03d}.png"
-                zf.writestr(filename, img_bytes.getvalue())
-        zip_buffer.seek(0)
-        
-        print(f"✓ ZIP大小: {len(zip_buffer.getvalue())} bytes")
-        print("========== 请求处理成功 ==========\n")
-        
-        return send_file(
-            zip_buffer,
-            mimetype="application/zip",
-            as_attachment=True,
-            download_name="handwritten_pages.zip",
-        )
+        else:
+            # 多页：逐页渲染并流式打包ZIP
+            print("流式打包多页ZIP...")
+            mimetype, download_name = "application/zip", "handwritten_pages.zip"
+            chunks = logged_stream(stream_png_zip(params, seed, png=png), "")
+            if cache_key:
+                chunks = RENDER_CACHE.store(cache_key, chunks, mimetype, download_name)
+            response = attachment_response(chunks, mimetype, download_name)
+        
+        if cache_key:
+            response.set_etag(cache_key)
+        return response
     
     except Exception as e:
         print(f"\n!!! 严重错误 !!!")
@@ -440,162 +2386,378 @@ def render_image():
 
 
 @app.post("/api/render-pdf")
+@profiled
 def render_pdf():
     """PDF生成API - 将手写体图片合并为PDF"""
     print("\n========== 开始处理PDF生成请求 ==========")
     
     try:
-        # 获取请求数据
+        # 获取并校验参数
         data = request.get_json() or {}
-        text = (data.get("text") or "").strip()
-        
-        if not text:
-            return jsonify({"error": "请输入文字"}), 400
-        
-        # 获取参数
-        font_key = data.get("font", "pingfang")
-        font_weight = int(data.get("font_weight", 400))
-        chars_per_line = int(data.get("chars_per_line", 26))
-        lines_per_page = int(data.get("lines_per_page", 20))
-        font_size_mode = data.get("font_size_mode", "medium")  # 默认中等字体
-        enable_errors = data.get("enable_errors", False)
-        jitter_level = int(data.get("jitter_level", 6))
-        jitter_level = max(0, min(10, jitter_level))
-        
-        print(f"PDF生成参数: 字体={font_key}, 每行={chars_per_line}字, 每页={lines_per_page}行")
-        
-        # A4纸尺寸 (300 DPI)
-        width, height = 2480, 3508
-        margin = 160
-        bg_color = (255, 255, 255)
-        text_color = (30, 30, 30)
-        
-        # 字体大小设置
-        if font_size_mode == "small":
-            font_size = 60
-        elif font_size_mode == "large":
-            font_size = 100
-        else:  # medium 默认
-            font_size = 80
-        
-        line_height = int(font_size * 1.4)
-        stroke_width = max(0, (font_weight - 400) // 100)
-        
-        # 加载字体
-        font_path = get_font_path(font_key)
         try:
-            font = ImageFont.truetype(font_path, font_size)
-        except:
-            font = ImageFont.load_default()
-        
-        # 切分文本
-        logical_lines = []
-        for para in text.split("\n"):
-            if not para.strip():
-                logical_lines.append("")
-                continue
-            para = para.strip()
-            while para:
-                logical_lines.append(para[:chars_per_line])
-                para = para[chars_per_line:]
+            params = parse_render_params(data, default_jitter=6)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        if not logical_lines:
-            logical_lines = [""]
+        print(f"PDF生成参数: 字体={params.font_key}, 每行={params.chars_per_line}字, 每页={params.lines_per_page}行")
         
-        total_lines = len(logical_lines)
-        MAX_PAGES = 50
-        estimated_pages = (total_lines + lines_per_page - 1) // lines_per_page
+        total_lines, estimated_pages = estimate_pages(params)
         
         if estimated_pages > MAX_PAGES:
             return jsonify({"error": f"文本过长，请分批处理（最多{MAX_PAGES}页）"}), 400
         
-        # 生成图片页面
-        pages = []
-        idx = 0
-        
-        while idx < total_lines and len(pages) < MAX_PAGES:
-            image = Image.new("RGB", (width, height), color=bg_color)
-            draw = ImageDraw.Draw(image)
-            current_y = margin
-            
-            lines_this_page = logical_lines[idx : idx + lines_per_page]
-            
-            for line in lines_this_page:
-                if current_y > height - margin - line_height:
-                    break
-                
-                # 抖动效果
-                line_v_range = jitter_level * 3
-                line_h_range = jitter_level * 4
-                char_v_range = jitter_level * 2
-                char_h_range = int(jitter_level * 1.5)
-                
-                line_v_jitter = random.randint(-line_v_range, line_v_range) if line_v_range > 0 else 0
-                line_h_jitter = random.randint(-line_h_range, line_h_range) if line_h_range > 0 else 0
-                
-                base_y = current_y + line_v_jitter
-                x = margin + line_h_jitter
-                
-                for ch in line:
-                    jitter_x = random.randint(-char_h_range, char_h_range) if char_h_range > 0 else 0
-                    jitter_y = random.randint(-char_v_range, char_v_range) if char_v_range > 0 else 0
-                    
-                    if stroke_width > 0:
-                        draw.text((x + jitter_x, base_y + jitter_y), ch, fill=text_color, font=font, stroke_width=stroke_width, stroke_fill=text_color)
-                    else:
-                        draw.text((x + jitter_x, base_y + jitter_y), ch, fill=text_color, font=font)
-                    
-                    try:
-                        bbox = draw.textbbox((0, 0), ch, font=font)
-                        w = bbox[2] - bbox[0]
-                    except:
-                        w = font_size
-                    
-                    x += w + random.randint(-2, 4)
-                
-                current_y += line_height + random.randint(-4, 4)
-            
-            pages.append(image)
-            idx += lines_per_page
+        # 输出模式：raster 为整页图片（默认），vector 为嵌入字体的矢量文字
+        pdf_mode = data.get("pdf_mode", "raster")
+        if pdf_mode not in ("raster", "vector"):
+            return jsonify({"error": "pdf_mode 必须是 raster 或 vector"}), 400
+        if pdf_mode == "vector" and not supports_vector_pdf(params.font_key):
+            print(f"⚠️ 字体 {params.font_key} 不支持矢量输出，改用图片模式")
+            pdf_mode = "raster"
+        
+        # 指定 seed 的请求结果确定，可以使用 ETag 和渲染缓存
+        seed = resolve_seed(params)
+        output = "pdf" if pdf_mode == "raster" else "pdf-vector"
+        cache_key = render_cache_key(output, params) if params.seed is not None else None
+        if cache_key:
+            if request.if_none_match.contains(cache_key):
+                return not_modified(cache_key)
+            cached = RENDER_CACHE.get(cache_key)
+            response = send_cached_render(cached, cache_key) if cached else None
+            if response is not None:
+                return response
+        
+        if admit_request(render_cost(params, output, estimated_pages)) is None:
+            return over_capacity()
+        
+        mimetype, download_name = "application/pdf", "handwritten_pages.pdf"
+        
+        if pdf_mode == "vector":
+            layout = layout_document(params, seed)
+            with timed("vector_pdf"):
+                pdf_bytes = render_vector_pdf(layout)
+            print(f"✓ 矢量PDF生成完成，大小: {len(pdf_bytes)} bytes")
+            print("========== PDF请求处理成功 ==========\n")
+            if cache_key:
+                RENDER_CACHE.put(cache_key, pdf_bytes, mimetype, download_name)
+            response = send_file(
+                BytesIO(pdf_bytes),
+                mimetype=mimetype,
+                as_attachment=True,
+                download_name=download_name,
+            )
+            if cache_key:
+                response.set_etag(cache_key)
+            return response
+        
+        # 逐页渲染并流式写出PDF
+        chunks = logged_stream(stream_pdf(params, seed), "PDF")
+        if cache_key:
+            chunks = RENDER_CACHE.store(cache_key, chunks, mimetype, download_name)
+        response = attachment_response(chunks, mimetype, download_name)
+        if cache_key:
+            response.set_etag(cache_key)
+        return response
+    
+    except Exception as e:
+        print(f"PDF生成错误: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"PDF生成失败: {str(e)}"}), 500
+
+
+@app.post("/api/preview")
+def preview():
+    """预览API - 按导出相同的排版以低分辨率渲染，返回每页的 WebP/JPEG 缩略图
+
+    字形位置由 300 DPI 排版坐标按比例换算。output 为 image / pdf，决定未指定
+    jitter_level 时的默认抖动（与 /api/render-image、/api/render-pdf 相同）；
+    返回的 seed 和 jitter_level 原样传给对应的导出接口，导出结果与预览一致。
+    """
+    print("\n========== 开始处理预览请求 ==========")
+    
+    try:
+        data = request.get_json() or {}
+        output = data.get("output", "image")
+        if output not in JOB_OUTPUTS:
+            return jsonify({"error": "output 必须是 image 或 pdf"}), 400
+        try:
+            params = parse_render_params(data, default_jitter=JOB_OUTPUTS[output][0])
+            options = parse_preview_options(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        print(f"生成 {len(pages)} 页图片")
+        _, estimated_pages = estimate_pages(params)
+        if estimated_pages > MAX_PAGES:
+            return jsonify({"error": f"文本过长，请分批处理（最多{MAX_PAGES}页）"}), 400
         
-        # 生成PDF
-        pdf_buffer = BytesIO()
+        selected = options.pages or list(range(1, estimated_pages + 1))
+        if any(page < 1 or page > estimated_pages for page in selected):
+            return jsonify({"error": f"pages 必须在1-{estimated_pages}之间"}), 400
+        
+        seed = resolve_seed(params)
+        scale = options.dpi / 300
+        if admit_request(render_cost(params, "image", len(selected)) * max(0.05, scale * scale)) is None:
+            return over_capacity()
+        print(f"预览参数: 字体={params.font_key}, DPI={options.dpi}, 格式={options.format}, 页面={selected}")
+        
+        pages = paginate(split_lines(params.text, params.chars_per_line), params.lines_per_page)
+        ids = page_ids(pages)
+        data_url_prefix = f"data:{PREVIEW_FORMATS[options.format][1]};base64,"
+        previews = []
+        for page in selected:
+            layout = layout_single_page(params, ids[page - 1], pages[page - 1], seed)
+            with timed("rasterize"):
+                image = rasterize_page(layout, 0, scale=scale)
+            image_bytes = encode_preview(image, options.format, options.quality)
+            previews.append({
+                "page": page,
+                "width": image.width,
+                "height": image.height,
+                "image": data_url_prefix + base64.b64encode(image_bytes).decode("ascii"),
+            })
+        
+        print(f"✓ 预览完成: {len(previews)} 页")
+        print("========== 预览请求处理成功 ==========\n")
+        return jsonify({
+            "seed": seed,
+            "jitter_level": params.jitter_level,
+            "dpi": options.dpi,
+            "scale": scale,
+            "total_pages": estimated_pages,
+            "pages": previews,
+        })
+    
+    except Exception as e:
+        print(f"预览生成错误: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"预览生成失败: {str(e)}"}), 500
+
+
+@app.post("/api/batch")
+def render_batch():
+    """批量渲染API - 请求体为 JSONL（每行一个文档，参数同 /api/jobs），返回包含各文档输出和 manifest.json 的 ZIP"""
+    print("\n========== 开始处理批量渲染请求 ==========")
+    
+    documents = parse_batch_lines(request.get_data(as_text=True))
+    if not documents:
+        return jsonify({"error": "请提供至少一个文档（JSONL，每行一个）"}), 400
+    if len(documents) > BATCH_MAX_DOCUMENTS:
+        return jsonify({"error": f"文档过多，每批最多{BATCH_MAX_DOCUMENTS}个"}), 400
+    
+    print(f"文档数: {len(documents)}, 并发: {BATCH_WORKERS}")
+    chunks = logged_stream(stream_batch_archive(documents), "批量渲染")
+    return attachment_response(chunks, "application/zip", "handwritten_batch.zip")
+
+
+@app.post("/api/jobs")
+def create_job():
+    """异步渲染API - 立即返回任务ID，后台逐页渲染"""
+    print("\n========== 收到异步渲染任务 ==========")
+    
+    try:
+        data = request.get_json() or {}
+        output = data.get("output", "image")
+        if output not in JOB_OUTPUTS:
+            return jsonify({"error": "output 必须是 image 或 pdf"}), 400
         
-        if len(pages) == 1:
-            # 单页PDF
-            pages[0].save(pdf_buffer, format="PDF", resolution=300.0)
-        else:
-            # 多页PDF
-            pages[0].save(
-                pdf_buffer, 
-                format="PDF", 
-                resolution=300.0,
-                save_all=True, 
-                append_images=pages[1:]
-            )
+        try:
+            params = parse_render_params(data, default_jitter=JOB_OUTPUTS[output][0])
+            png = parse_png_options(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        pdf_buffer.seek(0)
+        _, estimated_pages = estimate_pages(params)
+        if estimated_pages > MAX_PAGES:
+            return jsonify({"error": f"文本过长，请分批处理（最多{MAX_PAGES}页）"}), 400
         
-        print(f"✓ PDF生成完成，大小: {len(pdf_buffer.getvalue())} bytes")
-        print("========== PDF请求处理成功 ==========\n")
+        store = get_job_store()
+        store.purge_expired(JOB_TTL_SECONDS)
+        job_id = store.create(output, estimated_pages)
+        seed = resolve_seed(params)
+        get_job_pool().submit(run_render_job, store, job_id, output, params, seed, estimated_pages, png)
         
-        return send_file(
-            pdf_buffer,
-            mimetype="application/pdf",
-            as_attachment=True,
-            download_name="handwritten_pages.pdf"
-        )
+        print(f"任务 {job_id}: 输出={output}, 预计页数={estimated_pages}")
+        return jsonify({"job_id": job_id, "status": "queued", "total_pages": estimated_pages}), 202
     
     except Exception as e:
-        print(f"PDF生成错误: {str(e)}")
         import traceback
         traceback.print_exc()
-        return jsonify({"error": f"PDF生成失败: {str(e)}"}), 500
+        return jsonify({"error": f"创建任务失败: {str(e)}"}), 500
+
+
+@app.get("/api/jobs/<job_id>")
+def get_job(job_id):
+    """查询任务状态和逐页进度"""
+    store = get_job_store()
+    store.fail_stale(JOB_STALE_SECONDS, job_id)
+    job = store.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    
+    return jsonify({
+        "job_id": job["id"],
+        "output": job["output"],
+        "status": job["status"],
+        "total_pages": job["total_pages"],
+        "done_pages": job["done_pages"],
+        "error": job["error"],
+    })
+
+
+@app.get("/api/jobs/<job_id>/result")
+def get_job_result(job_id):
+    """下载任务结果"""
+    store = get_job_store()
+    store.fail_stale(JOB_STALE_SECONDS, job_id)
+    job = store.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    if job["status"] == "failed":
+        return jsonify({"error": f"任务失败: {job['error']}"}), 500
+    if job["status"] != "done" or not os.path.exists(job["result_path"] or ""):
+        return jsonify({"error": "任务尚未完成", "status": job["status"]}), 409
+    
+    return send_file(
+        job["result_path"],
+        mimetype=job["mimetype"],
+        as_attachment=True,
+        download_name=job["download_name"],
+    )
+
+
+# PDF编辑区域的渲染分辨率（像素/点）
+REGION_RENDER_SCALE = 3
+# 区域文字的样式参数（整份文档相同）
+RegionStyle = namedtuple("RegionStyle", ["font_key", "font_weight", "jitter_level", "font_size_mode"])
+# 一页的叠加图：rect 为 PDF 坐标 (x0, y0, x1, y1)，samples 为预乘透明度后的像素，
+# gray 为 True 时是 灰度+透明度，否则是 RGBA。可以在进程间传递
+PageOverlay = namedtuple("PageOverlay", ["rect", "gray", "width", "height", "samples"])
+
+
+def compose_page_overlay(placed, scale):
+    """把一页上各区域的 RGBA 图片合成为一张透明叠加图
+
+    placed 为 [(x, y, 图片)]，x/y 是区域左上角的 PDF 坐标。叠加图只覆盖各区域的
+    外接矩形；手写文字是灰色时按 灰度+透明度 存储，数据量是 RGBA 的一半。
+    """
+    x0 = min(x for x, _, _ in placed)
+    y0 = min(y for _, y, _ in placed)
+    offsets = [(round((x - x0) * scale), round((y - y0) * scale)) for x, y, _ in placed]
+    width = max(dx + img.width for (dx, _), (_, _, img) in zip(offsets, placed))
+    height = max(dy + img.height for (_, dy), (_, _, img) in zip(offsets, placed))
+
+    overlay = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+    for offset, (_, _, img) in zip(offsets, placed):
+        overlay.alpha_composite(img, offset)
+
+    # MuPDF 的带透明通道的 pixmap 使用预乘颜色
+    gray = is_gray(TEXT_COLOR)
+    samples = np.asarray(overlay.convert("LA") if gray else overlay, dtype=np.uint16)
+    samples[..., :-1] = (samples[..., :-1] * samples[..., -1:] + 127) // 255
+    rect = (x0, y0, x0 + width / scale, y0 + height / scale)
+    return PageOverlay(rect, gray, width, height, samples.astype(np.uint8).tobytes())
+
+
+def overlay_pixmap(overlay):
+    colorspace = fitz.csGRAY if overlay.gray else fitz.csRGB
+    return fitz.Pixmap(colorspace, overlay.width, overlay.height, overlay.samples, True)
+
+
+def render_region_page(style, page_regions, page_seed):
+    """排版并光栅化一页上的所有编辑区域，合成为一张叠加图（没有可绘制的区域时返回 None）
+
+    每页使用由 page_seed 初始化的独立随机数，串行和并行渲染结果一致。
+    """
+    rng = random.Random(page_seed)
+    # 本页各区域的 (x, y, RGBA 图片)，最后合成一张叠加图插入
+    placed = []
+    for region in page_regions:
+        text = region.get('text', '').strip()
+        if not text:
+            continue
+        
+        # 区域坐标 (从canvas坐标转换为PDF坐标)
+        x = float(region.get('x', 0))
+        y = float(region.get('y', 0))
+        width = float(region.get('width', 100))
+        height = float(region.get('height', 50))
+        
+        # 计算字体大小 - 使用用户选择的字号
+        # 小:12px, 中:16px, 大:20px 对应到前端预览
+        if style.font_size_mode == 'small':
+            base_font_size = 12
+        elif style.font_size_mode == 'large':
+            base_font_size = 20
+        else:  # medium
+            base_font_size = 16
+        
+        # 根据区域高度进行微调，确保文字不超出边界
+        font_size = min(base_font_size, height * 0.8)
+        font_size = max(8, min(font_size, 48))  # 限制范围
+        
+        # 创建手写体图片
+        img_width = int(width * REGION_RENDER_SCALE)  # 3倍分辨率
+        img_height = int(height * REGION_RENDER_SCALE)
+        
+        if img_width < 10 or img_height < 10:
+            continue
+        
+        # 排版 + 渲染文字到透明背景图片 (带抖动效果，3倍分辨率)
+        with timed("layout"):
+            region_layout = layout_region(
+                text,
+                style.font_key,
+                int(font_size * REGION_RENDER_SCALE),
+                stroke_width_for(style.font_weight),
+                style.jitter_level,
+                img_width,
+                img_height,
+                rng,
+            )
+        with timed("rasterize"):
+            img = rasterize_page(region_layout, 0, mode="RGBA", background=(255, 255, 255, 0))
+        placed.append((x, y, img))
+    
+    if not placed:
+        return None
+    with timed("rasterize"):
+        return compose_page_overlay(placed, REGION_RENDER_SCALE)
+
+
+def _pooled_render_region_page(style, page_regions, page_seed):
+    with record_stages() as timings:
+        result = render_region_page(style, page_regions, page_seed)
+    return result, timings
+
+
+def iter_region_overlays(style, pages, seed):
+    """按页序产出 (页码, 叠加图)；开启 RENDER_WORKERS 时多页并行渲染
+
+    pages 为 [(页码, 区域列表)]。插入 PDF 仍在调用方（主线程）按页序进行。
+    """
+    parallel = RENDER_WORKERS > 1 and len(pages) > 1
+    pending = deque()
+    for page_num, page_regions in pages:
+        # 未指定 seed 时每页取一个随机种子，避免子进程继承相同的随机状态
+        page_seed = f"{seed}:{page_num}" if seed is not None else random.getrandbits(64)
+        if parallel:
+            future = get_render_pool().submit(_pooled_render_region_page, style, page_regions, page_seed)
+            pending.append((page_num, future))
+        else:
+            pending.append((page_num, render_region_page(style, page_regions, page_seed)))
+
+        # 最多提前提交 2 倍进程数的页面，避免叠加图在内存中堆积
+        while pending and (not parallel or len(pending) >= RENDER_WORKERS * 2):
+            page_num, result = pending.popleft()
+            yield page_num, _collect_pooled_result(result) if parallel else result
+    while pending:
+        page_num, result = pending.popleft()
+        yield page_num, _collect_pooled_result(result) if parallel else result
 
 
 @app.post("/api/edit-pdf")
+@profiled
 def edit_pdf():
     """PDF编辑API - 在上传的PDF上添加手写体文字"""
     print("\n========== 开始处理PDF编辑请求 ==========")
@@ -612,6 +2774,7 @@ def edit_pdf():
         regions = data.get('regions', [])
         if not regions:
             return jsonify({"error": "请框选要填写的区域"}), 400
+        save_options = parse_pdf_save_options(data)
         
         # 获取字体设置
         font_key = data.get('font', 'pingfang')
@@ -619,153 +2782,54 @@ def edit_pdf():
         jitter_level = int(data.get('jitter_level', 0))  # PDF编辑模式默认不抖动
         jitter_level = max(0, min(10, jitter_level))
         font_size_mode = data.get('font_size_mode', 'medium')  # 获取字体大小设置
+        try:
+            seed = parse_seed(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        style = RegionStyle(font_key, font_weight, jitter_level, font_size_mode)
         
         print(f"PDF编辑参数: 字体={font_key}, 粗细={font_weight}, 抖动={jitter_level}, 字号={font_size_mode}")
         print(f"框选区域数: {len(regions)}")
         
-        # 加载字体文件
-        font_path = get_font_path(font_key)
-        if not os.path.exists(font_path):
-            font_path = get_font_path('lxgw')  # 降级到默认字体
-        
-        # 读取PDF
-        pdf_bytes = pdf_file.read()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        
-        print(f"PDF页数: {len(doc)}")
-        
-        # 按页分组区域
-        regions_by_page = {}
-        for region in regions:
-            page_num = region.get('pageNum', 1)
-            if page_num not in regions_by_page:
-                regions_by_page[page_num] = []
-            regions_by_page[page_num].append(region)
-        
-        # 处理每个页面
-        for page_num, page_regions in regions_by_page.items():
-            if page_num > len(doc):
-                continue
-            
-            page = doc[page_num - 1]  # fitz使用0索引
-            page_rect = page.rect
+        # 上传的PDF落盘后按路径打开
+        with uploaded_pdf(pdf_file) as doc:
+            # 按页分组区域
+            regions_by_page = {}
+            for region in regions:
+                page_num = region.get('pageNum', 1)
+                if page_num not in regions_by_page:
+                    regions_by_page[page_num] = []
+                regions_by_page[page_num].append(region)
             
-            print(f"  处理第{page_num}页，区域数: {len(page_regions)}")
+            # 有效的页码，按页序排列
+            pages = [
+                (page_num, regions_by_page[page_num])
+                for page_num in sorted(regions_by_page)
+                if 1 <= page_num <= len(doc)
+            ]
             
-            for region in page_regions:
-                text = region.get('text', '').strip()
-                if not text:
-                    continue
-                
-                # 区域坐标 (从canvas坐标转换为PDF坐标)
-                x = float(region.get('x', 0))
-                y = float(region.get('y', 0))
-                width = float(region.get('width', 100))
-                height = float(region.get('height', 50))
-                
-                # 计算字体大小 - 使用用户选择的字号
-                # 小:12px, 中:16px, 大:20px 对应到前端预览
-                if font_size_mode == 'small':
-                    base_font_size = 12
-                elif font_size_mode == 'large':
-                    base_font_size = 20
-                else:  # medium
-                    base_font_size = 16
-                
-                # 根据区域高度进行微调，确保文字不超出边界
-                font_size = min(base_font_size, height * 0.8)
-                font_size = max(8, min(font_size, 48))  # 限制范围
-                
-                # 创建手写体图片
-                img_width = int(width * 3)  # 3倍分辨率
-                img_height = int(height * 3)
-                
-                if img_width < 10 or img_height < 10:
+            # 各页的排版和光栅化可以并行，插入PDF在这里按页序进行；
+            # 一页只插入一张叠加图，不再每个区域各编码、解码一次PNG
+            for page_num, overlay in iter_region_overlays(style, pages, seed):
+                print(f"  处理第{page_num}页，区域数: {len(regions_by_page[page_num])}")
+                if overlay is None:
                     continue
-                
-                # 创建透明背景图片
-                img = Image.new('RGBA', (img_width, img_height), (255, 255, 255, 0))
-                draw = ImageDraw.Draw(img)
-                
-                # 加载字体
-                pil_font_size = int(font_size * 3)
-                try:
-                    pil_font = ImageFont.truetype(font_path, pil_font_size)
-                except:
-                    pil_font = ImageFont.load_default()
-                
-                # 字体加粗
-                stroke_width = max(0, (font_weight - 400) // 100)
-                
-                # 渲染文字 (带抖动效果)
-                text_color = (30, 30, 30, 255)
-                current_x = 5
-                current_y = 5
-                
-                # 计算抖动范围
-                char_h_range = int(jitter_level * 1.5)
-                char_v_range = jitter_level * 2
-                
-                for char in text:
-                    if char == '\n':
-                        current_x = 5
-                        current_y += int(pil_font_size * 1.2)
-                        continue
-                    
-                    # 字符抖动
-                    jitter_x = random.randint(-char_h_range, char_h_range) if char_h_range > 0 else 0
-                    jitter_y = random.randint(-char_v_range, char_v_range) if char_v_range > 0 else 0
-                    
-                    draw.text(
-                        (current_x + jitter_x, current_y + jitter_y),
-                        char,
-                        fill=text_color,
-                        font=pil_font,
-                        stroke_width=stroke_width,
-                        stroke_fill=text_color if stroke_width > 0 else None
-                    )
-                    
-                    # 计算字符宽度
-                    try:
-                        bbox = draw.textbbox((0, 0), char, font=pil_font)
-                        char_width = bbox[2] - bbox[0]
-                    except:
-                        char_width = pil_font_size
-                    
-                    current_x += char_width + random.randint(-1, 2)
-                    
-                    # 换行检查
-                    if current_x > img_width - pil_font_size:
-                        current_x = 5
-                        current_y += int(pil_font_size * 1.2)
-                
-                # 将图片转换为字节
-                img_buffer = BytesIO()
-                img.save(img_buffer, format='PNG')
-                img_buffer.seek(0)
-                
-                # 将图片插入PDF
-                img_rect = fitz.Rect(x, y, x + width, y + height)
-                page.insert_image(img_rect, stream=img_buffer.getvalue())
-                
-                print(f"    插入文字: '{text[:20]}...' at ({x:.1f}, {y:.1f})")
-        
-        # 保存编辑后的PDF
-        output_buffer = BytesIO()
-        doc.save(output_buffer)
-        doc.close()
-        output_buffer.seek(0)
+                page = doc[page_num - 1]  # fitz使用0索引
+                with timed("pdf_insert"):
+                    page.insert_image(fitz.Rect(overlay.rect), pixmap=overlay_pixmap(overlay))
+            
+            # 保存编辑后的PDF
+            response = send_pdf_document(doc, "edited_document.pdf", save_options)
         
-        print(f"✓ PDF编辑完成，大小: {len(output_buffer.getvalue())} bytes")
         print("========== PDF编辑请求处理成功 ==========\n")
-        
-        return send_file(
-            output_buffer,
-            mimetype="application/pdf",
-            as_attachment=True,
-            download_name="edited_document.pdf"
-        )
+        return response
     
+    except ValueError as e:
+        print(f"✗ 请求无效: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+    except RequestEntityTooLarge:
+        # 交给 request_too_large 返回 413
+        raise
     except Exception as e:
         print(f"PDF编辑错误: {str(e)}")
         import traceback
@@ -773,9 +2837,31 @@ def edit_pdf():
         return jsonify({"error": f"PDF编辑失败: {str(e)}"}), 500
 
 
+def region_image_bytes(region, files):
+    """取区域截图：优先读二进制 part（imagePart 指向 multipart 字段名），兼容 base64 data URL"""
+    part = region.get('imagePart')
+    if part:
+        upload = files.get(part)
+        if upload is None:
+            raise ValueError(f"缺少截图 {part}")
+        upload.stream.seek(0)
+        return upload.read()
+
+    image_data = region.get('image', '')
+    # 移除data:image/png;base64,前缀
+    if ',' in image_data:
+        image_data = image_data.split(',', 1)[1]
+    return base64.b64decode(image_data)
+
+
 @app.post("/api/edit-pdf-screenshot")
+@profiled
 def edit_pdf_screenshot():
-    """PDF编辑API - 使用截图方式保证所见即所得"""
+    """PDF编辑API - 使用截图方式保证所见即所得
+
+    截图可作为独立的二进制 multipart 字段上传，区域里用 imagePart 指向字段名
+    （多个区域可共用同一字段）；旧的 base64 image 字段仍然兼容。
+    """
     print("\n========== 开始处理PDF截图编辑请求 ==========")
     
     try:
@@ -790,77 +2876,78 @@ def edit_pdf_screenshot():
         regions = data.get('regions', [])
         if not regions:
             return jsonify({"error": "请框选要填写的区域"}), 400
+        save_options = parse_pdf_save_options(data)
         
         print(f"框选区域数: {len(regions)}")
         
-        # 读取PDF
-        pdf_bytes = pdf_file.read()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        
-        print(f"PDF页数: {len(doc)}")
-        
-        # 按页分组区域
-        regions_by_page = {}
-        for region in regions:
-            page_num = region.get('pageNum', 1)
-            if page_num not in regions_by_page:
-                regions_by_page[page_num] = []
-            regions_by_page[page_num].append(region)
-        
-        # 处理每个页面
-        for page_num, page_regions in regions_by_page.items():
-            if page_num > len(doc):
-                continue
+        # 上传的PDF落盘后按路径打开
+        with uploaded_pdf(pdf_file) as doc:
+            # 按页分组区域
+            regions_by_page = {}
+            for region in regions:
+                page_num = region.get('pageNum', 1)
+                if page_num not in regions_by_page:
+                    regions_by_page[page_num] = []
+                regions_by_page[page_num].append(region)
             
-            page = doc[page_num - 1]  # fitz使用0索引
+            # 截图摘要 -> 已嵌入图片的 xref
+            image_xrefs = {}
+            reused = 0
             
-            print(f"  处理第{page_num}页，区域数: {len(page_regions)}")
-            
-            for region in page_regions:
-                image_data = region.get('image', '')
-                if not image_data:
+            # 处理每个页面
+            for page_num, page_regions in regions_by_page.items():
+                if page_num > len(doc):
                     continue
                 
-                # 区域坐标
-                x = float(region.get('x', 0))
-                y = float(region.get('y', 0))
-                width = float(region.get('width', 100))
-                height = float(region.get('height', 50))
+                page = doc[page_num - 1]  # fitz使用0索引
                 
-                # 解析base64图片
-                try:
-                    # 移除data:image/png;base64,前缀
-                    if ',' in image_data:
-                        image_data = image_data.split(',')[1]
-                    
-                    img_bytes = base64.b64decode(image_data)
+                print(f"  处理第{page_num}页，区域数: {len(page_regions)}")
+                
+                for region in page_regions:
+                    if not region.get('image') and not region.get('imagePart'):
+                        continue
                     
-                    # 将图片插入PDF
-                    img_rect = fitz.Rect(x, y, x + width, y + height)
-                    page.insert_image(img_rect, stream=img_bytes)
+                    # 区域坐标
+                    x = float(region.get('x', 0))
+                    y = float(region.get('y', 0))
+                    width = float(region.get('width', 100))
+                    height = float(region.get('height', 50))
                     
-                    print(f"    插入截图 at ({x:.1f}, {y:.1f}), 大小: {width:.1f}x{height:.1f}")
+                    # 缺少截图或 base64 无效时抛出 ValueError，整个请求返回 400
+                    img_bytes = region_image_bytes(region, request.files)
+                    digest = hashlib.sha256(img_bytes).hexdigest()
                     
-                except Exception as e:
-                    print(f"    插入图片失败: {str(e)}")
-                    continue
-        
-        # 保存编辑后的PDF
-        output_buffer = BytesIO()
-        doc.save(output_buffer)
-        doc.close()
-        output_buffer.seek(0)
+                    try:
+                        # 将图片插入PDF；相同截图只嵌入一次，之后按 xref 引用
+                        img_rect = fitz.Rect(x, y, x + width, y + height)
+                        with timed("pdf_insert"):
+                            if digest in image_xrefs:
+                                page.insert_image(img_rect, xref=image_xrefs[digest])
+                                reused += 1
+                            else:
+                                image_xrefs[digest] = page.insert_image(img_rect, stream=img_bytes)
+                        
+                        print(f"    插入截图 at ({x:.1f}, {y:.1f}), 大小: {width:.1f}x{height:.1f}")
+                        
+                    except Exception as e:
+                        print(f"    插入图片失败: {str(e)}")
+                        continue
+            
+            if reused:
+                print(f"  复用已嵌入的截图 {reused} 次，共嵌入 {len(image_xrefs)} 张")
+            
+            # 保存编辑后的PDF
+            response = send_pdf_document(doc, "edited_document.pdf", save_options)
         
-        print(f"✓ PDF编辑完成，大小: {len(output_buffer.getvalue())} bytes")
         print("========== PDF截图编辑请求处理成功 ==========\n")
-        
-        return send_file(
-            output_buffer,
-            mimetype="application/pdf",
-            as_attachment=True,
-            download_name="edited_document.pdf"
-        )
+        return response
     
+    except ValueError as e:
+        print(f"✗ 请求无效: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+    except RequestEntityTooLarge:
+        # 交给 request_too_large 返回 413
+        raise
     except Exception as e:
         print(f"PDF截图编辑错误: {str(e)}")
         import traceback
@@ -0,0 +1,51 @@
+"""批量渲染命令行工具（不启动 Flask 服务）
+
+输入为 JSONL，每行一个文档，参数与 /api/jobs 相同（output 为 image 或 pdf，
+可选 id 用作输出文件名）。输出一个 ZIP，包含各文档的结果和 manifest.json。
+
+用法:
+    python batch_render.py documents.jsonl -o out.zip --workers 4
+    cat documents.jsonl | python batch_render.py - -o out.zip
+"""
+import argparse
+import json
+import sys
+import zipfile
+
+import app as handwriting_app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量渲染手写体文档")
+    parser.add_argument("input", help="JSONL 文件路径，- 表示标准输入")
+    parser.add_argument("-o", "--output", default="handwritten_batch.zip")
+    parser.add_argument("--workers", type=int, default=handwriting_app.BATCH_WORKERS, help="同时渲染的文档数")
+    args = parser.parse_args(argv)
+
+    if args.input == "-":
+        text = sys.stdin.read()
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            text = f.read()
+
+    documents = handwriting_app.parse_batch_lines(text)
+    if not documents:
+        print("✗ 没有可渲染的文档", file=sys.stderr)
+        return 2
+
+    with open(args.output, "wb") as f:
+        for chunk in handwriting_app.stream_batch_archive(documents, args.workers):
+            f.write(chunk)
+
+    with zipfile.ZipFile(args.output) as zf:
+        manifest = json.loads(zf.read("manifest.json"))
+    print(
+        f"{manifest['documents'] - manifest['failed']}/{manifest['documents']} 个文档成功，"
+        f"耗时 {manifest['seconds']}s，结果已写入 {args.output}",
+        file=sys.stderr,
+    )
+    return 1 if manifest["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
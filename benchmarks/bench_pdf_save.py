@@ -0,0 +1,161 @@
+"""PDF 编辑结果保存方式基准测试
+
+对大体积源 PDF（扫描件式的整页图片、纯文字页面，或 --pdf 指定的文件）每页插入
+若干手写截图，然后按各保存方式（增量 / 完整重写 × garbage / deflate / 对象流）
+调用 app.save_edited_pdf，记录保存耗时和输出大小，结果写入 JSON。
+
+用法:
+    python benchmarks/bench_pdf_save.py --pages 40
+    python benchmarks/bench_pdf_save.py --pdf scan.pdf --modes incremental,full -o save.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+import app as handwriting_app  # noqa: E402
+
+PdfSaveOptions = handwriting_app.PdfSaveOptions
+MODES = {
+    "incremental": PdfSaveOptions("incremental", 0, False, False, False, False),
+    "incremental-deflate": PdfSaveOptions("incremental", 0, True, True, False, False),
+    # 改动前 doc.save() 的默认参数
+    "full": PdfSaveOptions("full", 0, False, False, False, False),
+    "full-deflate": PdfSaveOptions("full", 0, True, True, False, False),
+    "full-garbage3": PdfSaveOptions("full", 3, True, True, True, False),
+    "full-compact": PdfSaveOptions("full", 4, True, True, True, True),
+}
+REGIONS_PER_PAGE = 3
+
+
+def scan_pdf(path, pages):
+    """整页噪声图片，模拟扫描件（图片不可压缩，体积大）"""
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page(width=595, height=842)
+        pixmap = fitz.Pixmap(fitz.csRGB, 800, 1130, os.urandom(800 * 1130 * 3), False)
+        page.insert_image(page.rect, pixmap=pixmap)
+    doc.save(path, deflate=True)
+    doc.close()
+
+
+def text_pdf(path, pages):
+    """满页文字，内容流多、对象多"""
+    doc = fitz.open()
+    line = "The quick brown fox jumps over the lazy dog 0123456789 " * 2
+    for _ in range(pages):
+        page = doc.new_page(width=595, height=842)
+        for row in range(70):
+            page.insert_text((30, 30 + row * 11), line, fontsize=8)
+    doc.save(path, deflate=True)
+    doc.close()
+
+
+SOURCES = {"scan": scan_pdf, "text": text_pdf}
+
+
+def sample_stamp():
+    image = Image.new("RGBA", (600, 120), (255, 255, 255, 0))
+    ImageDraw.Draw(image).line([(10, 60), (590, 60)], fill=(30, 30, 30, 255), width=4)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def edit_document(doc, stamp):
+    """每页插入几处截图，相同图片按 xref 复用（与 /api/edit-pdf-screenshot 一致）"""
+    xref = 0
+    for page in doc:
+        for i in range(REGIONS_PER_PAGE):
+            rect = fitz.Rect(50, 60 + i * 70, 450, 110 + i * 70)
+            if xref:
+                page.insert_image(rect, xref=xref)
+            else:
+                xref = page.insert_image(rect, stream=stamp)
+
+
+def run_mode(source_path, options, stamp, workdir):
+    # 增量保存会改写源文件，每次都从副本开始
+    path = os.path.join(workdir, "input.pdf")
+    shutil.copyfile(source_path, path)
+    doc = fitz.open(path)
+    edit_document(doc, stamp)
+    start = time.perf_counter()
+    output = handwriting_app.save_edited_pdf(doc, options)
+    save_time = time.perf_counter() - start
+    doc.close()
+    size = os.path.getsize(output)
+    os.remove(output)
+    if os.path.exists(path):
+        os.remove(path)
+    return save_time, size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDF 编辑结果保存方式基准测试")
+    parser.add_argument("--pdf", action="append", default=[], help="源 PDF，可重复指定；不指定时生成样例")
+    parser.add_argument("--sources", default=",".join(SOURCES), help="生成的样例类型")
+    parser.add_argument("--pages", type=int, default=40, help="生成样例的页数")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--repeat", type=int, default=3, help="每种方式重复次数，取最快一次")
+    parser.add_argument("-o", "--output", default="bench_pdf_save.json")
+    args = parser.parse_args(argv)
+
+    modes = args.modes.split(",")
+    stamp = sample_stamp()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="handwriting-bench-save-") as workdir:
+        sources = [(os.path.basename(path), path) for path in args.pdf]
+        if not args.pdf:
+            for name in args.sources.split(","):
+                path = os.path.join(workdir, f"{name}.pdf")
+                SOURCES[name](path, args.pages)
+                sources.append((name, path))
+
+        for name, path in sources:
+            source_size = os.path.getsize(path)
+            with fitz.open(path) as doc:
+                pages = doc.page_count
+            print(f"{name}: {pages} 页，{source_size / 1e6:.1f}MB", file=sys.stderr)
+            for mode in modes:
+                save_time, size = min(
+                    run_mode(path, MODES[mode], stamp, workdir) for _ in range(args.repeat)
+                )
+                results.append({
+                    "source": name,
+                    "pages": pages,
+                    "source_bytes": source_size,
+                    "mode": mode,
+                    "options": MODES[mode]._asdict(),
+                    "save_time": save_time,
+                    "output_bytes": size,
+                })
+                print(f"  {mode:<20} {save_time:7.3f}s  {size / 1e6:8.2f}MB", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pymupdf": fitz.VersionBind,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
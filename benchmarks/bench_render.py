@@ -0,0 +1,317 @@
+"""渲染接口基准测试
+
+通过 Flask test client 直接调用 /api/render-image、/api/render-pdf、
+/api/edit-pdf、/api/edit-pdf-screenshot，按 文本长度 × 字体 × 字号 × 抖动 × 错字
+的组合逐个计时，记录耗时、峰值内存（RSS）和输出大小，结果写入 JSON。
+
+用法:
+    python benchmarks/bench_render.py --quick -o bench.json
+    python benchmarks/bench_render.py --baseline bench.json --threshold 15
+
+任何组合返回非 200 时以非零状态退出。指定 --baseline 时与基线逐项
+比较，任何一项的耗时、峰值内存或输出大小超出阈值百分比，或状态码与
+基线不同，也以非零状态退出。内存按每个组合的峰值增量（峰值 RSS 减去
+请求开始时的 RSS）比较，不受之前跑过的组合影响。
+"""
+import argparse
+import base64
+import itertools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from io import BytesIO
+
+# 基准测试不应命中磁盘渲染缓存和单页缓存，必须在导入 app 之前设置
+os.environ.setdefault("RENDER_CACHE_MAX_MB", "0")
+os.environ.setdefault("PAGE_CACHE_MAX_MB", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+import app as handwriting_app  # noqa: E402
+
+ENDPOINTS = ["render-image", "render-pdf", "edit-pdf", "edit-pdf-screenshot"]
+# 文本长度 -> 页数（0 表示只有一行）
+LENGTHS = {"line": 0, "page": 1, "5pages": 5, "20pages": 20, "50pages": 50}
+FONT_SIZE_MODES = ["small", "medium", "large"]
+JITTER_LEVELS = [0, 5, 10]
+
+CHARS_PER_LINE = 26
+LINES_PER_PAGE = 20
+# PDF 编辑每页框选的区域数
+REGIONS_PER_PAGE = 10
+# 峰值内存增量的变化小于这个值时不算回归（分配器复用已释放的堆，小的差异是噪声）
+RSS_NOISE_BYTES = 4 * 1024 * 1024
+SAMPLE_CHARS = "天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏人大木己又白有问上下小王，。"
+
+
+def sample_text(length):
+    pages = LENGTHS[length]
+    total = CHARS_PER_LINE * (LINES_PER_PAGE * pages if pages else 1)
+    return "".join(SAMPLE_CHARS[(i * 7) % len(SAMPLE_CHARS)] for i in range(total))
+
+
+def sample_pdf(pages):
+    doc = fitz.open()
+    for _ in range(max(1, pages)):
+        doc.new_page(width=595, height=842)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def sample_screenshot():
+    image = Image.new("RGBA", (600, 120), (255, 255, 255, 0))
+    ImageDraw.Draw(image).line([(10, 60), (590, 60)], fill=(30, 30, 30, 255), width=4)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def sample_regions(pages, text=None, image=None):
+    regions = []
+    for page_num in range(1, max(1, pages) + 1):
+        for i in range(REGIONS_PER_PAGE):
+            region = {"pageNum": page_num, "x": 50, "y": 60 + i * 70, "width": 400, "height": 50}
+            if text is not None:
+                region["text"] = text
+            if image is not None:
+                region["image"] = image
+            regions.append(region)
+    return regions
+
+
+def read_rss():
+    """当前进程的常驻内存（字节），仅 Linux 可用"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class PeakRssSampler:
+    """后台线程定时采样 RSS，记录一次请求期间的峰值
+
+    进程里已有字形缓存和之前各组合留下的堆，绝对 RSS 取决于之前跑过什么；
+    delta（峰值减去开始时的 RSS）才是本次请求额外占用的内存。
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, read_rss())
+            self._stop.wait(self.interval)
+
+    @property
+    def delta(self):
+        return self.peak - self.start
+
+    def __enter__(self):
+        self.start = self.peak = read_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, read_rss())
+
+
+def build_cases(args):
+    fonts = list(handwriting_app.AVAILABLE_FONTS) if args.fonts == "all" else args.fonts.split(",")
+    endpoints = args.endpoints.split(",")
+    lengths = args.lengths.split(",")
+    modes = args.modes.split(",")
+    jitters = [int(j) for j in args.jitter.split(",")]
+    errors = [e == "on" for e in args.errors.split(",")]
+
+    cases = []
+    for endpoint, length in itertools.product(endpoints, lengths):
+        if endpoint == "edit-pdf-screenshot":
+            # 截图模式与字体/抖动无关
+            cases.append({"endpoint": endpoint, "length": length})
+            continue
+        for font, mode, jitter in itertools.product(fonts, modes, jitters):
+            for enable_errors in errors if endpoint.startswith("render") else [False]:
+                cases.append({
+                    "endpoint": endpoint,
+                    "length": length,
+                    "font": font,
+                    "font_size_mode": mode,
+                    "jitter_level": jitter,
+                    "enable_errors": enable_errors,
+                })
+    return cases
+
+
+def case_id(case):
+    return "|".join(f"{key}={case[key]}" for key in sorted(case))
+
+
+def run_case(client, case):
+    endpoint = case["endpoint"]
+    pages = LENGTHS[case["length"]]
+    if endpoint.startswith("render"):
+        payload = {
+            "text": sample_text(case["length"]),
+            "font": case["font"],
+            "font_size_mode": case["font_size_mode"],
+            "jitter_level": case["jitter_level"],
+            "enable_errors": case["enable_errors"],
+            "chars_per_line": CHARS_PER_LINE,
+            "lines_per_page": LINES_PER_PAGE,
+            "seed": 1,
+        }
+        return client.post(f"/api/{endpoint}", json=payload)
+
+    if endpoint == "edit-pdf":
+        data = {
+            "font": case["font"],
+            "font_size_mode": case["font_size_mode"],
+            "jitter_level": case["jitter_level"],
+            "seed": 1,
+            "regions": sample_regions(pages, text="张三 2024年10月17日"),
+        }
+    else:
+        data = {"regions": sample_regions(pages, image=sample_screenshot())}
+    return client.post(
+        f"/api/{endpoint}",
+        data={"pdf": (BytesIO(sample_pdf(pages)), "input.pdf"), "data": json.dumps(data)},
+        content_type="multipart/form-data",
+    )
+
+
+def run_benchmarks(cases, repeat):
+    client = handwriting_app.app.test_client()
+    # 预热一次，避免首个组合把字体加载、进程池启动算进耗时
+    if cases:
+        run_case(client, cases[0]).close()
+    results = []
+    for i, case in enumerate(cases, start=1):
+        best = None
+        for _ in range(repeat):
+            with PeakRssSampler() as sampler:
+                start = time.perf_counter()
+                response = run_case(client, case)
+                output_bytes = len(response.get_data())
+                # 关闭响应才会释放准入控制的额度
+                response.close()
+                wall_time = time.perf_counter() - start
+            run = {
+                "wall_time": wall_time,
+                "peak_rss": sampler.peak,
+                "rss_delta": sampler.delta,
+                "output_bytes": output_bytes,
+                "status": response.status_code,
+            }
+            if best is None or run["wall_time"] < best["wall_time"]:
+                best = run
+        results.append({"id": case_id(case), **case, **best})
+        print(
+            f"[{i}/{len(cases)}] {case_id(case)}: {best['wall_time']:.3f}s, "
+            f"RSS +{best['rss_delta'] / 1e6:.1f}MB, {best['output_bytes']} bytes, HTTP {best['status']}",
+            file=sys.stderr,
+        )
+    return results
+
+
+def compare(results, baseline, threshold):
+    """返回超出阈值的回归项列表"""
+    baseline_by_id = {item["id"]: item for item in baseline["results"]}
+    regressions = []
+    for item in results:
+        base = baseline_by_id.get(item["id"])
+        if base is None:
+            continue
+        # 状态码变了说明结果不可比，耗时和内存也就没有意义
+        if item["status"] != base.get("status", 200):
+            regressions.append((item["id"], "status", base.get("status", 200), item["status"], None))
+            continue
+        for metric in ("wall_time", "rss_delta", "output_bytes"):
+            # 旧版本的基线没有 rss_delta
+            if base.get(metric, 0) <= 0:
+                continue
+            # 内存增量太小时百分比没有意义
+            if metric == "rss_delta" and item[metric] - base[metric] < RSS_NOISE_BYTES:
+                continue
+            change = (item[metric] - base[metric]) / base[metric] * 100
+            if change > threshold:
+                regressions.append((item["id"], metric, base[metric], item[metric], change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="手写体渲染接口基准测试")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--lengths", default=",".join(LENGTHS))
+    parser.add_argument("--fonts", default="all", help="字体 key，逗号分隔，或 all")
+    parser.add_argument("--modes", default=",".join(FONT_SIZE_MODES))
+    parser.add_argument("--jitter", default=",".join(str(j) for j in JITTER_LEVELS))
+    parser.add_argument("--errors", default="off,on", help="off,on")
+    parser.add_argument("--quick", action="store_true", help="只跑一小组代表性组合")
+    parser.add_argument("--repeat", type=int, default=1, help="每个组合重复次数，取最快一次")
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="用于比较的基线 JSON")
+    parser.add_argument("--threshold", type=float, default=10.0, help="允许的回归百分比")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.lengths = "line,page,5pages"
+        args.fonts = "xieyitisc"
+        args.modes = "medium"
+        args.jitter = "0,10"
+        args.errors = "on"
+
+    cases = build_cases(args)
+    print(f"共 {len(cases)} 个组合", file=sys.stderr)
+    results = run_benchmarks(cases, args.repeat)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}", file=sys.stderr)
+
+    exit_code = 0
+    # 请求失败时耗时只是出错路径的耗时，不能当成有效结果
+    for item in results:
+        if item["status"] != 200:
+            print(f"✗ 失败 {item['id']}: HTTP {item['status']}", file=sys.stderr)
+            exit_code = 1
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for item_id, metric, before, after, change in regressions:
+            if change is None:
+                print(f"✗ 回归 {item_id} {metric}: {before} -> {after}", file=sys.stderr)
+            else:
+                print(f"✗ 回归 {item_id} {metric}: {before:.4g} -> {after:.4g} (+{change:.1f}%)", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"✓ 无超过 {args.threshold}% 的回归", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
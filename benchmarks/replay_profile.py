@@ -0,0 +1,75 @@
+"""重放性能分析时保存的请求
+
+服务端开启 PROFILING_ENABLED=1 后，带 ?profile=1 的请求会把 cProfile 结果和
+请求内容保存到 PROFILE_DIR（<id>.prof / <id>.json / 上传的文件）。本脚本在本地
+通过 Flask test client 重放该请求并打印最耗时的函数。
+
+用法:
+    python benchmarks/replay_profile.py /tmp/handwriting-profiles/<id>.json
+    python benchmarks/replay_profile.py <id>.json --stored --sort tottime --top 40
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+from io import BytesIO
+
+# 重放不应命中渲染缓存和单页缓存，必须在导入 app 之前设置
+os.environ.setdefault("RENDER_CACHE_MAX_MB", "0")
+os.environ.setdefault("PAGE_CACHE_MAX_MB", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as handwriting_app  # noqa: E402
+
+
+def replay(record, directory):
+    """重放一次请求，返回 (cProfile.Profile, 响应, 耗时)"""
+    client = handwriting_app.app.test_client()
+    if record["json"] is not None:
+        kwargs = {"json": record["json"]}
+    else:
+        data = dict(record["form"])
+        for field, info in record["files"].items():
+            with open(os.path.join(directory, info["path"]), "rb") as f:
+                data[field] = (BytesIO(f.read()), info["filename"])
+        kwargs = {"data": data, "content_type": "multipart/form-data"}
+
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    response = client.post(record["path"], **kwargs)
+    response.get_data()
+    response.close()
+    profiler.disable()
+    return profiler, response, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="重放保存的请求并打印热点函数")
+    parser.add_argument("record", help="性能分析保存的 <id>.json")
+    parser.add_argument("--stored", action="store_true", help="不重放，直接查看服务端保存的 .prof")
+    parser.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "ncalls"])
+    parser.add_argument("--top", type=int, default=25, help="打印的函数数量")
+    args = parser.parse_args(argv)
+
+    with open(args.record, encoding="utf-8") as f:
+        record = json.load(f)
+    directory = os.path.dirname(os.path.abspath(args.record))
+    print(f"请求: {record['path']}，原始耗时 {record.get('elapsed', 0):.2f}s，状态 {record.get('status')}", file=sys.stderr)
+
+    if args.stored:
+        stats = pstats.Stats(os.path.join(directory, f"{record['id']}.prof"), stream=sys.stdout)
+    else:
+        profiler, response, elapsed = replay(record, directory)
+        print(f"重放耗时 {elapsed:.2f}s，状态 {response.status_code}", file=sys.stderr)
+        stats = pstats.Stats(profiler, stream=sys.stdout)
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
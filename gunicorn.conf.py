@@ -0,0 +1,36 @@
+"""gunicorn 配置（Procfile 通过 -c gunicorn.conf.py 使用）
+
+preload 应用，并在 master 中预热字体和字形缓存后再 fork worker，
+worker 以写时复制方式共享这些缓存，部署或回收 worker 后没有冷启动。
+"""
+import gc
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+preload_app = True
+
+# 渲染是 CPU 密集型：每个 CPU 一个进程；少量线程处理上传和流式输出时的 IO 等待
+workers = int(os.environ.get("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "2"))
+
+# 50 页的同步渲染可能超过默认的 30 秒
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+
+# 定期回收 worker，限制大页面缓冲带来的内存增长；jitter 避免所有 worker 同时重启
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "500"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+
+
+def when_ready(server):
+    """应用已在 master 中加载、worker 尚未 fork：预热缓存并冻结 GC
+
+    gc.freeze() 把预热后的对象移出 GC 跟踪，避免 worker 中的垃圾回收
+    触碰这些对象导致共享页面被复制。
+    """
+    import app
+
+    app.warm_caches()
+    gc.freeze()
@@ -687,6 +687,13 @@ function applyJitterEffect(textArea, jitterLevel) {
     }
 }
 
+// 计算截图的 SHA-256，用于去重；非安全上下文下不可用时返回 null
+async function imageDigest(blob) {
+    if (!window.crypto || !window.crypto.subtle) return null;
+    const hash = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(hash), b => b.toString(16).padStart(2, '0')).join('');
+}
+
 /**
  * 导出编辑后的PDF - 使用截图方式保证所见即所得
  */
@@ -722,6 +729,9 @@ async function exportEditedPdf() {
     try {
         // 为每个区域生成截图
         const regionsWithImages = [];
+        // 截图以二进制字段上传，相同截图（如每页同样的签名）只上传一次
+        const imageParts = [];          // [字段名, Blob]
+        const partsByDigest = new Map(); // 摘要 -> 字段名
         
         for (const region of pdfEditor.regions) {
             if (!region.text.trim()) continue;
@@ -802,8 +812,14 @@ async function exportEditedPdf() {
                     useCORS: true
                 });
                 
-                // 转换为base64
-                const imageData = canvas.toDataURL('image/png');
+                const blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/png'));
+                const digest = await imageDigest(blob);
+                let imagePart = digest && partsByDigest.get(digest);
+                if (!imagePart) {
+                    imagePart = `image-${imageParts.length}`;
+                    imageParts.push([imagePart, blob]);
+                    if (digest) partsByDigest.set(digest, imagePart);
+                }
                 
                 regionsWithImages.push({
                     pageNum: region.pageNum,
@@ -811,7 +827,7 @@ async function exportEditedPdf() {
                     y: region.y / pdfEditor.scale,
                     width: region.width / pdfEditor.scale,
                     height: region.height / pdfEditor.scale,
-                    image: imageData  // base64图片
+                    imagePart: imagePart  // 对应的 multipart 字段名
                 });
                 
             } finally {
@@ -833,7 +849,7 @@ async function exportEditedPdf() {
             return;
         }
         
-        console.log('已生成截图数:', regionsWithImages.length);
+        console.log('已生成截图数:', regionsWithImages.length, '去重后上传:', imageParts.length);
 
         // 创建FormData上传PDF和截图数据
         const formData = new FormData();
@@ -841,6 +857,9 @@ async function exportEditedPdf() {
         const pdfBlob = new Blob([pdfEditor.pdfBytes], { type: 'application/pdf' });
         formData.append('pdf', pdfBlob, 'original.pdf');
         formData.append('data', JSON.stringify({ regions: regionsWithImages }));
+        for (const [name, blob] of imageParts) {
+            formData.append(name, blob, `${name}.png`);
+        }
 
         const response = await fetch('/api/edit-pdf-screenshot', {
             method: 'POST',